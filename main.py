@@ -1,31 +1,34 @@
+from __future__ import annotations
+
 import os
+import sys
+import socket
 import time
 import re
 import json
 import random
 import threading
-from flask import Flask
+import zlib
+import gzip
+import math
+import csv
+import base64
+import tempfile
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict, deque
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-from telegram import (
-    Update, 
-    ReplyKeyboardMarkup, 
-    ReplyKeyboardRemove, 
-    InlineKeyboardButton, 
-    InlineKeyboardMarkup
-)
-from telegram.ext import (
-    Updater, 
-    CommandHandler, 
-    MessageHandler, 
-    Filters, 
-    CallbackContext, 
-    ConversationHandler,
-    CallbackQueryHandler
-)
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 import sqlite3
 
+# Тяжелые модули (Flask, python-telegram-bot, lxml) импортируются
+# по требованию: health-эндпоинт и воркеры стартуют без них
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
 load_dotenv()
 
 # Стадии диалога
@@ -46,43 +49,358 @@ USER_AGENTS = [
     'Mozilla/5.0 (Linux; Android 11; SM-G998B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.120 Mobile Safari/537.36'
 ]
 
-app = Flask(__name__)
+# Пул исходящих маршрутов: HTTP-прокси и локальные адреса через запятую
+EGRESS_PROXIES = [p.strip() for p in os.getenv('EGRESS_PROXIES', '').split(',') if p.strip()]
+EGRESS_SOURCE_ADDRESSES = [a.strip() for a in os.getenv('EGRESS_SOURCE_ADDRESSES', '').split(',') if a.strip()]
+EGRESS_RATE_PER_MINUTE = float(os.getenv('EGRESS_RATE_PER_MINUTE', '30'))  # Лимит запросов на один маршрут
+EGRESS_BAN_SECONDS = int(os.getenv('EGRESS_BAN_SECONDS', '900'))  # Пауза для маршрута после блокировки
+EGRESS_WAIT_TIMEOUT = int(os.getenv('EGRESS_WAIT_TIMEOUT', '60'))  # Сколько ждать свободный маршрут
+EGRESS_LAST_ROUTE_COOLDOWN = int(os.getenv('EGRESS_LAST_ROUTE_COOLDOWN', '30'))  # Пауза вместо бана последнего маршрута
+
+# База данных
+DB_PATH = os.getenv('DB_PATH', 'kufar_bot.db')
+DB_TIMEOUT = int(os.getenv('DB_TIMEOUT', '30'))  # Ожидание блокировки другими процессами, сек
+
+# Режим парсинга: inline — в процессе бота, workers — отдельными процессами `python main.py worker`
+CRAWL_MODE = os.getenv('CRAWL_MODE', 'inline')
+WORKER_BATCH = int(os.getenv('WORKER_BATCH', '5'))  # Сколько ссылок воркер берет за раз
+LEASE_SECONDS = int(os.getenv('LEASE_SECONDS', '300'))  # Срок аренды ссылки воркером
+WORKER_IDLE_SLEEP = int(os.getenv('WORKER_IDLE_SLEEP', '10'))
+DELIVERY_INTERVAL = int(os.getenv('DELIVERY_INTERVAL', '10'))  # Как часто бот рассылает готовые уведомления
+
+# Сколько последних ID объявлений помнить для каждой ссылки
+SEEN_IDS_LIMIT = int(os.getenv('SEEN_IDS_LIMIT', '500'))
+
+# Агрегаты цен для /stats
+PRICE_STATS_DAYS = int(os.getenv('PRICE_STATS_DAYS', '90'))  # Сколько дней хранить дневные корзины
+PRICE_BUCKET_BASE = 1.05  # Шаг корзин гистограммы: ~5% по цене
+PRICE_BUCKETS = 300  # 1.05^300 покрывает цены до ~2 млн BYN
+
+# Поиск повторно выложенных объявлений (MinHash + LSH)
+LSH_BANDS = 8
+LSH_ROWS = 4
+LSH_PERMUTATIONS = LSH_BANDS * LSH_ROWS
+LSH_TTL_DAYS = int(os.getenv('LSH_TTL_DAYS', '14'))  # Сколько дней помнить объявления
+LSH_MAX_ADS = int(os.getenv('LSH_MAX_ADS', '50000'))  # ~1 КБ памяти на объявление в каждом процессе
+LSH_SYNC_OVERLAP = 5  # Запас в секундах при подгрузке подписей, записанных другими процессами
+LSH_BUCKET_LIMIT = 50  # Больше объявлений с одинаковой полосой не храним (шаблонные тексты)
+REPOST_SIMILARITY = float(os.getenv('REPOST_SIMILARITY', '0.8'))  # Оценка сходства Жаккара
+REPOST_PRICE_TOLERANCE = float(os.getenv('REPOST_PRICE_TOLERANCE', '0.3'))  # Допустимая разница цен
+REPOST_MIN_SHINGLES = int(os.getenv('REPOST_MIN_SHINGLES', '40'))  # Короче — только шаблонный заголовок, не сравниваем
+
+# Закладки: отдельные объявления, которые обновляются вне поисковой выдачи
+WATCH_INTERVAL = int(os.getenv('WATCH_INTERVAL', '3600'))  # Как часто обновлять объявление из закладок
+WATCH_BATCH = int(os.getenv('WATCH_BATCH', '10'))  # Не больше запросов за цикл на все закладки
+WATCH_LIMIT = int(os.getenv('WATCH_LIMIT', '50'))  # Закладок на пользователя
+WATCH_TEXT = "👁 *Закладки*"
+
+# Лента событий: обход пишет события, стадии читают их пачками от своей отметки
+FEED_BATCH = int(os.getenv('FEED_BATCH', '200'))
+FEED_RETENTION_DAYS = int(os.getenv('FEED_RETENTION_DAYS', '7'))  # Запас для перезапуска стадий без повторного обхода
+FEED_STAGES = [s.strip() for s in os.getenv('FEED_STAGES', 'notify,history,risk').split(',') if s.strip()]  # Стадии в процессе бота
+RISK_LOW_PRICE_RATIO = float(os.getenv('RISK_LOW_PRICE_RATIO', '0.5'))  # Подозрительно: дешевле половины медианы поиска
+RISK_DROP_RATIO = float(os.getenv('RISK_DROP_RATIO', '0.5'))  # Подозрительно: цену снизили больше чем вдвое
+RISK_MIN_ADS = 10  # Медиане поиска верим, когда за ней хотя бы столько объявлений
+
+# Выгрузка и загрузка данных: `python main.py export|import|backup <файл>`
+DUMP_CHUNK = int(os.getenv('DUMP_CHUNK', '10000'))  # Строк в одной транзакции импорта
+DUMP_COLUMNS = {
+    'users': ('user_id', 'chat_id'),
+    'urls': ('user_id', 'url', 'last_id', 'seen_ids'),
+    'filters': ('user_id', 'min_price', 'max_price', 'keywords'),
+    'price_history': ('user_id', 'ad_id', 'title', 'price', 'url', 'timestamp')
+}
+DUMP_BLOB_COLUMNS = {'seen_ids'}  # В JSON Lines и CSV байты пишутся в base64
+
+# Снимок состояния парсера для быстрого перезапуска
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'crawl_state.json.gz')
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', '300'))
+SNAPSHOT_MAX_AGE = int(os.getenv('SNAPSHOT_MAX_AGE', '86400'))  # Более старый снимок игнорируется
+
+# Периодическая проверка
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', '360'))  # 6 минут
+CYCLE_BUDGET = int(os.getenv('CYCLE_BUDGET', str(CHECK_INTERVAL - 60)))  # Дедлайн одного цикла
+
+# Обработка апдейтов: медленные обработчики идут в ограниченный пул
+DISPATCHER_WORKERS = int(os.getenv('DISPATCHER_WORKERS', '4'))
+HANDLER_WORKERS = int(os.getenv('HANDLER_WORKERS', '8'))
+HANDLER_QUEUE_LIMIT = int(os.getenv('HANDLER_QUEUE_LIMIT', '100'))  # Больше — отвечаем «занят»
+# Долгие обработчики (ручной парсинг) — в своем маленьком пуле, чтобы быстрые не ждали за ними
+CRAWL_HANDLER_WORKERS = int(os.getenv('CRAWL_HANDLER_WORKERS', '2'))
+CRAWL_HANDLER_QUEUE_LIMIT = int(os.getenv('CRAWL_HANDLER_QUEUE_LIMIT', '10'))
+BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте через минуту"
+
+# Общий кэш результатов парсинга для периодических и ручных проверок
+PARSE_CACHE_TTL = int(os.getenv('PARSE_CACHE_TTL', '180'))
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', '5000'))
+
+# Справедливая очередь: лимиты одного пользователя за цикл
+USER_URL_BUDGET = int(os.getenv('USER_URL_BUDGET', '20'))
+USER_REQUEST_BUDGET = int(os.getenv('USER_REQUEST_BUDGET', '40'))
+
+# Состояние циклов проверки
+cycle_lock = threading.Lock()
+carry_over_ids = []  # Ссылки, до которых не дошел прошлый цикл
+cycle_history = deque(maxlen=100)
+manual_runs = set()  # Пользователи с активным ручным парсингом
+manual_runs_lock = threading.Lock()
+seen_sets = {}  # url_id -> SeenSet
+seen_sets_lock = threading.Lock()
+url_last_polled = {}  # url_id -> время последней проверки
+url_fingerprints = {}  # url_id -> отпечаток выдачи (ID и цены) при последней проверке
+crawl_state_lock = threading.Lock()  # Запись в url_last_polled/url_fingerprints и их копия для снимка
+last_cycle_started = 0.0
+user_lag = {}  # user_id -> на сколько секунд опаздывает самая старая ссылка
 
-@app.route('/')
 def health_check():
     """Эндпоинт для UptimeRobot"""
     return "✅ Kufar Bot PRO is alive!", 200
 
+def metrics():
+    """Эндпоинт с состоянием парсера"""
+    from flask import jsonify
+    
+    return jsonify({
+        'egress': EGRESS_POOL.stats(),
+        'parse_cache': PARSE_CACHE.stats(),
+        'layout': dict(layout_stats),
+        'handlers': HANDLER_METRICS.stats(),
+        'handler_pool': HANDLER_POOL.stats(),
+        'crawl_handler_pool': CRAWL_HANDLER_POOL.stats(),
+        'cycles': list(cycle_history)[-10:],
+        'carry_over': len(carry_over_ids),
+        'feed_lag': get_feed_lag(),
+        'user_lag': sorted(
+            (get_user_lag_from_db() if CRAWL_MODE == 'workers' else user_lag).items(),
+            key=lambda item: -item[1]
+        )[:20]
+    })
+
+def create_app():
+    """Flask-приложение для health-check и метрик"""
+    from flask import Flask
+    
+    app = Flask(__name__)
+    app.add_url_rule('/', 'health_check', health_check)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    return app
+
 def run_flask():
     """Запуск Flask в фоновом потоке"""
-    app.run(host="0.0.0.0", port=PORT)
+    create_app().run(host="0.0.0.0", port=PORT)
+
+def load_telegram():
+    """Импорт python-telegram-bot при запуске бота (воркерам он не нужен)"""
+    global Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
+    global Updater, CommandHandler, MessageHandler, Filters, CallbackContext
+    global ConversationHandler, CallbackQueryHandler
+    from telegram import (
+        Update, 
+        ReplyKeyboardMarkup, 
+        ReplyKeyboardRemove, 
+        InlineKeyboardButton, 
+        InlineKeyboardMarkup
+    )
+    from telegram.ext import (
+        Updater, 
+        CommandHandler, 
+        MessageHandler, 
+        Filters, 
+        CallbackContext, 
+        ConversationHandler,
+        CallbackQueryHandler
+    )
 
 def get_random_user_agent():
     """Выбирает случайный User-Agent для защиты от блокировок"""
     return random.choice(USER_AGENTS)
 
+class SourceAddressAdapter(HTTPAdapter):
+    """HTTP-адаптер, привязывающий исходящие соединения к локальному адресу"""
+
+    def __init__(self, source_address: str, **kwargs):
+        self.source_address = (source_address, 0)
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['source_address'] = self.source_address
+        super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['source_address'] = self.source_address
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+class Egress:
+    """Исходящий маршрут (прокси или локальный адрес) с оценкой здоровья"""
+
+    def __init__(self, name: str, proxy: str = None, source_address: str = None,
+                 rate_per_minute: float = EGRESS_RATE_PER_MINUTE):
+        self.name = name
+        self.session = requests.Session()
+        if proxy:
+            self.session.proxies = {'http': proxy, 'https': proxy}
+        if source_address:
+            adapter = SourceAddressAdapter(source_address)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+        self.min_interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.next_allowed = 0.0
+        self.banned_until = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.bans = 0
+        self.latency = None  # Скользящее среднее времени ответа, сек
+        self.in_flight = 0
+
+    def ready_at(self) -> float:
+        """Момент, когда маршрут снова можно использовать"""
+        return max(self.next_allowed, self.banned_until)
+
+    def score(self) -> float:
+        """Вес маршрута: доля успешных ответов с учетом скорости"""
+        success_rate = (self.successes + 1) / (self.successes + self.failures + 2)
+        latency = max(self.latency or 1.0, 0.05)
+        return success_rate ** 2 / latency / (1 + self.in_flight)
+
+    def stats(self) -> dict:
+        """Состояние маршрута для логов и метрик"""
+        return {
+            'name': self.name,
+            'successes': self.successes,
+            'failures': self.failures,
+            'bans': self.bans,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'banned': self.banned_until > time.monotonic(),
+            'score': round(self.score(), 3)
+        }
+
+class EgressPool:
+    """Пул исходящих маршрутов со взвешенным выбором и лимитами на маршрут"""
+
+    def __init__(self, egresses: list):
+        self.egresses = egresses
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> 'EgressPool':
+        """Собирает пул из EGRESS_PROXIES и EGRESS_SOURCE_ADDRESSES"""
+        egresses = [Egress(f"proxy:{proxy}", proxy=proxy) for proxy in EGRESS_PROXIES]
+        egresses += [Egress(f"bind:{address}", source_address=address) for address in EGRESS_SOURCE_ADDRESSES]
+        if not egresses:
+            egresses = [Egress('direct')]
+        return cls(egresses)
+
+    def acquire(self, timeout: float = EGRESS_WAIT_TIMEOUT) -> Egress:
+        """Выбирает здоровый маршрут; ждет, если все заняты лимитом или забанены"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                ready = [e for e in self.egresses if e.ready_at() <= now]
+                if ready:
+                    egress = random.choices(ready, weights=[e.score() for e in ready])[0]
+                    # Случайный разброс интервала, чтобы запросы не шли ровной сеткой
+                    egress.next_allowed = now + egress.min_interval * random.uniform(0.5, 1.5)
+                    egress.in_flight += 1
+                    return egress
+                wait = min(e.ready_at() for e in self.egresses) - now
+
+            if now + wait > deadline:
+                return None
+            time.sleep(min(wait, 5.0))
+
+    def report(self, egress: Egress, ok: bool, latency: float, banned: bool = False):
+        """Обновляет оценку маршрута по результату запроса"""
+        with self.lock:
+            egress.in_flight = max(egress.in_flight - 1, 0)
+            egress.latency = latency if egress.latency is None else egress.latency * 0.8 + latency * 0.2
+            if ok:
+                egress.successes += 1
+            else:
+                egress.failures += 1
+            if banned:
+                egress.bans += 1
+                now = time.monotonic()
+                # Повторные баны удлиняют паузу, но не больше чем в 8 раз
+                pause = EGRESS_BAN_SECONDS * min(2 ** (egress.bans - 1), 8)
+                if not any(e.banned_until <= now for e in self.egresses if e is not egress):
+                    # Последний рабочий маршрут не выключаем: короткая пауза, и запросы ждут его
+                    pause = min(pause, EGRESS_LAST_ROUTE_COOLDOWN)
+                egress.banned_until = now + pause
+                print(f"⛔ Маршрут {egress.name} заблокирован на {pause} с")
+
+    def stats(self) -> list:
+        """Состояние всех маршрутов"""
+        with self.lock:
+            return [e.stats() for e in self.egresses]
+
+EGRESS_POOL = EgressPool.from_env()
+
+# Счетчик HTTP-запросов текущего потока (для бюджета пользователя)
+request_counter = threading.local()
+
+def requests_made() -> int:
+    """Сколько запросов сделал текущий поток"""
+    return getattr(request_counter, 'count', 0)
+
+# Признаки страницы-проверки Cloudflare (простое упоминание Cloudflare, например
+# скрипт аналитики на обычной странице, блокировкой не считается)
+CHALLENGE_MARKERS = ('_cf_chl_opt', 'cf-browser-verification', '<title>just a moment...</title>')
+
+def is_blocked_response(response: requests.Response) -> bool:
+    """Проверка на блокировку Cloudflare или лимит запросов"""
+    if response.status_code in (403, 429) or response.headers.get('cf-mitigated') == 'challenge':
+        return True
+    text = response.text.lower()
+    return any(marker in text for marker in CHALLENGE_MARKERS)
+
+def fetch_url(url: str, headers: dict, timeout: int = 15) -> requests.Response:
+    """Загружает страницу через лучший доступный маршрут из пула"""
+    egress = EGRESS_POOL.acquire()
+    if egress is None:
+        raise RuntimeError("Нет доступных исходящих маршрутов")
+
+    request_counter.count = requests_made() + 1
+    started = time.monotonic()
+    try:
+        response = egress.session.get(url, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        EGRESS_POOL.report(egress, ok=False, latency=time.monotonic() - started)
+        raise
+
+    blocked = is_blocked_response(response)
+    EGRESS_POOL.report(
+        egress,
+        ok=response.ok and not blocked,
+        latency=time.monotonic() - started,
+        banned=blocked
+    )
+    return response
+
+# Рисковые фразы: строки-константы общие для всех объявлений
+RISKY_PHRASES = {
+    'high': tuple(sys.intern(p) for p in ["предоплата", "перевод на карту", "не встретимся", "только онлайн", "залог денег", "гарантийный платеж"]),
+    'medium': tuple(sys.intern(p) for p in ["срочная продажа", "торг", "уступлю", "без торга", "залог", "документы на руках", "продаю за другого"])
+}
+
 def analyze_ad_risk(text: str) -> dict:
     """
     Анализирует текст на риски мошенничества
     Возвращает: {'risk_level': 0-2, 'phrases': ['фраза1', 'фраза2']}
     """
-    risky_phrases = {
-        'high': ["предоплата", "перевод на карту", "не встретимся", "только онлайн", "залог денег", "гарантийный платеж"],
-        'medium': ["срочная продажа", "торг", "уступлю", "без торга", "залог", "документы на руках", "продаю за другого"]
-    }
-    
     found_phrases = []
     risk_level = 0
     
     # Поиск рисковых фраз
     text_lower = text.lower()
     
-    for phrase in risky_phrases['high']:
+    for phrase in RISKY_PHRASES['high']:
         if phrase in text_lower:
             found_phrases.append(phrase)
             risk_level = max(risk_level, 2)  # Высокий риск
     
-    for phrase in risky_phrases['medium']:
+    for phrase in RISKY_PHRASES['medium']:
         if phrase in text_lower:
             found_phrases.append(phrase)
             if risk_level < 2:  # Не перекрываем высокий риск
@@ -97,11 +415,203 @@ def analyze_ad_risk(text: str) -> dict:
     
     return {
         'risk_level': risk_level,
-        'phrases': found_phrases,
-        'text': text[:200]  # Для логирования
+        'phrases': found_phrases
     }
 
-def get_risk_message(risk_ dict) -> str:
+ITEM_URL_PREFIX = sys.intern('https://kufar.by/item/')
+CURRENCY = sys.intern('BYN')
+NO_PHRASES = ()
+
+class Listing:
+    """Неизменяемая компактная запись объявления; отображаемые поля считаются по запросу"""
+    __slots__ = ('id', 'title', 'price_int', 'risk_level', 'risk_phrases', 'repost_of')
+
+    def __init__(self, ad_id, title: str, price_int: int, risk_data: dict = None):
+        risk_data = risk_data or {}
+        phrases = risk_data.get('phrases')
+        object.__setattr__(self, 'id', ad_id)
+        object.__setattr__(self, 'title', title)
+        object.__setattr__(self, 'price_int', price_int)
+        object.__setattr__(self, 'risk_level', risk_data.get('risk_level', 0))
+        object.__setattr__(self, 'risk_phrases', tuple(phrases) if phrases else NO_PHRASES)
+        object.__setattr__(self, 'repost_of', risk_data.get('repost_of'))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Listing нельзя изменять")
+
+    def __delattr__(self, name):
+        raise AttributeError("Listing нельзя изменять")
+
+    def __repr__(self):
+        return f"Listing({self.id!r}, {self.title!r}, {self.price_int})"
+
+    @property
+    def price(self) -> str:
+        """Цена для сообщения"""
+        return f"{self.price_int} {CURRENCY}"
+
+    @property
+    def url(self) -> str:
+        """Ссылка на объявление"""
+        return f"{ITEM_URL_PREFIX}{self.id}"
+
+    @property
+    def risk_data(self) -> dict:
+        """Результат анализа рисков в формате analyze_ad_risk"""
+        return {'risk_level': self.risk_level, 'phrases': list(self.risk_phrases), 'repost_of': self.repost_of}
+
+def listing_to_row(item: Listing) -> list:
+    """Listing в список для JSON-снимка"""
+    return [item.id, item.title, item.price_int, item.risk_level, list(item.risk_phrases), item.repost_of]
+
+def listing_from_row(row: list) -> Listing:
+    """Listing из строки JSON-снимка"""
+    ad_id, title, price_int, risk_level, phrases, *rest = row
+    return Listing(ad_id, title, price_int, {
+        'risk_level': risk_level,
+        'phrases': [sys.intern(phrase) for phrase in phrases],
+        'repost_of': rest[0] if rest else None
+    })
+
+NON_WORD_RE = re.compile(r'[^\w]+')
+MERSENNE_PRIME = (1 << 61) - 1
+# Фиксированное зерно: подписи сохраняются в БД и должны совпадать между запусками
+_permutation_rng = random.Random(20240601)
+MINHASH_PERMUTATIONS = [
+    (_permutation_rng.randrange(1, MERSENNE_PRIME), _permutation_rng.randrange(0, MERSENNE_PRIME))
+    for _ in range(LSH_PERMUTATIONS)
+]
+
+def text_shingles(text: str) -> set:
+    """Хэши 4-символьных шинглов нормализованного текста"""
+    text = NON_WORD_RE.sub(' ', text.lower()).strip()
+    return {zlib.crc32(text[i:i + 4].encode()) for i in range(max(len(text) - 3, 1))}
+
+def minhash_signature(shingles: set) -> bytes:
+    """MinHash-подпись по шинглам, упакованная в байты (4 байта на перестановку)"""
+    return array('I', (
+        min((a * x + b) % MERSENNE_PRIME for x in shingles) & 0xFFFFFFFF
+        for a, b in MINHASH_PERMUTATIONS
+    )).tobytes()
+
+class LSHIndex:
+    """LSH-индекс MinHash-подписей недавних объявлений с вытеснением по времени"""
+
+    def __init__(self, ttl_days: int = LSH_TTL_DAYS, max_ads: int = LSH_MAX_ADS):
+        self.ttl = ttl_days * 86400
+        self.max_ads = max_ads
+        self.ads = OrderedDict()  # ключ объявления -> (подпись, цена, время, ключ оригинала)
+        self.buckets = {}  # ключ полосы -> ключ объявления или кортеж ключей
+        self.pending = []  # новые подписи для записи в БД
+        self.synced_at = 0.0  # до какого момента подгружены подписи из БД
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def band_keys(signature: bytes) -> list:
+        """Ключи полос подписи (живут только в памяти процесса)"""
+        width = LSH_ROWS * 4
+        return [hash((band, signature[band * width:(band + 1) * width])) for band in range(LSH_BANDS)]
+
+    def get(self, ad_key: int):
+        """Запись объявления, если оно уже в индексе"""
+        with self.lock:
+            return self.ads.get(ad_key)
+
+    def query(self, signature: bytes, price: int, exclude: int = None):
+        """Ближайшее похожее объявление с близкой ценой: ключ или None"""
+        with self.lock:
+            candidates = set()
+            for key in self.band_keys(signature):
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    continue
+                candidates.update(bucket if isinstance(bucket, tuple) else (bucket,))
+            candidates.discard(exclude)
+            
+            best, best_similarity = None, REPOST_SIMILARITY
+            values = array('I', signature)
+            for candidate in candidates:
+                other_signature, other_price = self.ads[candidate][:2]
+                if price and other_price and abs(price - other_price) > REPOST_PRICE_TOLERANCE * max(price, other_price):
+                    continue
+                similarity = sum(1 for a, b in zip(values, array('I', other_signature)) if a == b) / LSH_PERMUTATIONS
+                if similarity >= best_similarity:
+                    best, best_similarity = candidate, similarity
+            return best
+
+    def add(self, ad_key: int, signature: bytes, price: int, seen_at: float,
+            repost_of: int = None, persist: bool = True):
+        """Добавляет объявление в индекс и вытесняет устаревшие"""
+        with self.lock:
+            cutoff = time.time() - self.ttl
+            if ad_key in self.ads or seen_at < cutoff:
+                return
+            self.ads[ad_key] = (signature, price, seen_at, repost_of)
+            for key in self.band_keys(signature):
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    self.buckets[key] = ad_key
+                elif isinstance(bucket, tuple):
+                    self.buckets[key] = (bucket + (ad_key,))[-LSH_BUCKET_LIMIT:]
+                else:
+                    self.buckets[key] = (bucket, ad_key)
+            if persist:
+                self.pending.append((ad_key, signature, price, seen_at, repost_of))
+            
+            # Записи идут почти в порядке появления (чужие подписи приходят с опозданием)
+            while self.ads and (len(self.ads) > self.max_ads or next(iter(self.ads.values()))[2] < cutoff):
+                self._remove(next(iter(self.ads)))
+
+    def _remove(self, ad_key: int):
+        signature = self.ads.pop(ad_key)[0]
+        for key in self.band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket == ad_key:
+                del self.buckets[key]
+            elif isinstance(bucket, tuple):
+                rest = tuple(k for k in bucket if k != ad_key)
+                if len(rest) > 1:
+                    self.buckets[key] = rest
+                elif rest:
+                    self.buckets[key] = rest[0]
+                else:
+                    del self.buckets[key]
+
+    def take_pending(self) -> list:
+        """Забирает подписи, ожидающие записи в БД"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            return pending
+
+LSH_INDEX = LSHIndex()
+
+def check_repost(ad_id, title: str, description: str, price: int):
+    """ID вероятного оригинала, если объявление — повтор недавнего; подпись считается один раз"""
+    ad_key = seen_key(ad_id)
+    entry = LSH_INDEX.get(ad_key)
+    if entry is not None:
+        return entry[3]
+    
+    # Один заголовок («iPhone 13», «Диван») совпадает у разных продавцов — нужен текст описания
+    if not description.strip():
+        return None
+    shingles = text_shingles(f"{title} {description}")
+    if len(shingles) < REPOST_MIN_SHINGLES:
+        return None
+    
+    signature = minhash_signature(shingles)
+    repost_of = LSH_INDEX.query(signature, price, exclude=ad_key)
+    LSH_INDEX.add(ad_key, signature, price, time.time(), repost_of)
+    return repost_of
+
+def mark_repost(risk_analysis: dict, repost_of) -> dict:
+    """Добавляет к анализу рисков признак повторного объявления"""
+    if repost_of:
+        risk_analysis['repost_of'] = repost_of
+        risk_analysis['risk_level'] = max(risk_analysis['risk_level'], 1)
+    return risk_analysis
+
+def get_risk_message(risk_data: dict) -> str:
     """Формирует текстовое сообщение на основе уровня риска"""
     if risk_data['risk_level'] == 0:
         return ""
@@ -115,10 +625,48 @@ def get_risk_message(risk_ dict) -> str:
     if risk_data['phrases']:
         phrases_text = "\n\n*Рисковые фразы в объявлении:* " + ", ".join(risk_data['phrases'])
     
-    return f"{messages[risk_data['risk_level']]}{phrases_text}"
+    repost_text = ""
+    if risk_data.get('repost_of'):
+        repost_text = f"\n\n♻️ *Похоже на повтор объявления:* {ITEM_URL_PREFIX}{risk_data['repost_of']}"
+    
+    return f"{messages[risk_data['risk_level']]}{phrases_text}{repost_text}"
 
-def parse_kufar_url(url: str, min_price: int = None, max_price: int = None, keywords: str = None) -> list:
-    """Парсит объявления с Kufar.by с фильтрами и защитой от блокировок"""
+PRICE_RE = re.compile(r'\d[\d \u00a0\u202f]*(?:[.,]\d+)?')
+layout_stats = defaultdict(int)  # счетчики разбора страниц для /metrics
+layout_stats_lock = threading.Lock()
+_page_xpaths = {}
+
+def page_xpaths() -> dict:
+    """Скомпилированные XPath-выражения разбора страницы (lxml грузится при первом вызове)"""
+    if not _page_xpaths:
+        from lxml.etree import XPath
+        
+        _page_xpaths.update({
+            'next_data': XPath('//script[@id="__NEXT_DATA__"]/text()'),
+            # Только внешние карточки: вложенные list-item__* — части той же карточки
+            'cards': XPath('//div[contains(@class, "list-item")]'
+                           '[not(ancestor::div[contains(@class, "list-item")])]'),
+            'link': XPath('(.//a[contains(@class, "title")])[1]'),
+            'price': XPath('string((.//div[contains(@class, "price")])[1])'),
+        })
+    return _page_xpaths
+
+def parse_price(text: str) -> int:
+    """Цена из текста карточки: '1 250,50 р.' -> 1250; «Договорная» -> 0"""
+    match = PRICE_RE.search(text or '')
+    if not match:
+        return 0
+    number = re.sub(r'[ \u00a0\u202f]', '', match.group()).replace(',', '.')
+    return int(float(number))
+
+def count_layout(name: str, amount: int = 1):
+    """Учитывает событие разбора страницы в метриках"""
+    with layout_stats_lock:
+        layout_stats[name] += amount
+
+def fetch_page(url: str, validators: tuple = None) -> requests.Response:
+    """Загружает страницу Kufar; None — страница не изменилась с прошлой загрузки (304).
+    validators — (ETag, Last-Modified) того результата, который будет возвращен при 304"""
     headers = {
         'User-Agent': get_random_user_agent(),
         'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
@@ -126,130 +674,319 @@ def parse_kufar_url(url: str, min_price: int = None, max_price: int = None, keyw
         'Connection': 'keep-alive'
     }
     
+    # Условный запрос: страница не изменилась — не скачиваем и не разбираем ее заново
+    if validators:
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    
+    # Паузы между запросами выдерживает пул маршрутов
+    response = fetch_url(url, headers)
+    
+    # Проверка на блокировку Cloudflare
+    if is_blocked_response(response):
+        print("⚠️ Обнаружена защита Cloudflare! Меняем User-Agent и маршрут...")
+        headers['User-Agent'] = get_random_user_agent()
+        response = fetch_url(url, headers)
+    
+    if response.status_code == 304 and validators:
+        return None
+    
+    response.raise_for_status()
+    return response
+
+def response_validators(response: requests.Response) -> tuple:
+    """(ETag, Last-Modified) ответа для следующего условного запроса или None"""
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    return (etag, last_modified) if etag or last_modified else None
+
+def fetch_listings(url: str, min_price: int = None, max_price: int = None, keywords: str = None,
+                   previous: tuple = None) -> tuple:
+    """Загружает и разбирает страницу Kufar.by: (объявления, валидаторы); ошибки загрузки пробрасываются.
+    previous — прошлые (объявления, валидаторы) этого же ключа: запрос условный, при 304 они возвращаются как есть"""
+    # Проверяем, есть ли в URL параметры цены
+    if min_price or max_price:
+        if 'prc=' not in url:
+            price_param = f"prc={min_price or 0}~{max_price or 0}"
+            url = url + ('&' if '?' in url else '?') + price_param
+    
+    response = fetch_page(url, previous[1] if previous else None)
+    if response is None:
+        return previous
+    validators = response_validators(response)
+    
+    from lxml import html as lxml_html
+    from lxml.etree import ParserError
+    
+    xpaths = page_xpaths()
     try:
-        # Случайная задержка от 1 до 3 секунд
-        time.sleep(random.uniform(1.0, 3.0))
-        
-        # Проверяем, есть ли в URL параметры цены
-        if min_price or max_price:
-            if 'prc=' not in url:
-                price_param = f"prc={min_price or 0}~{max_price or 0}"
-                url = url + ('&' if '?' in url else '?') + price_param
-        
-        response = requests.get(url, headers=headers, timeout=15)
-        
-        # Проверка на блокировку Cloudflare
-        if "cloudflare" in response.text.lower() or response.status_code == 403:
-            print("⚠️ Обнаружена защита Cloudflare! Меняем User-Agent...")
-            headers['User-Agent'] = get_random_user_agent()
-            response = requests.get(url, headers=headers, timeout=15)
-        
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'lxml')
-        
-        # Поиск объявлений (адаптировано под текущую верстку Kufar)
-        listings = []
-        script_tags = soup.find_all('script', {'id': '__NEXT_DATA__'})
-        
-        if script_tags:
-            try:
-                data = json.loads(script_tags[0].string)
-                items = data['props']['pageProps']['dehydratedState']['queries'][0]['state']['data']['ads']
+        tree = lxml_html.document_fromstring(response.text)
+    except ParserError:
+        count_layout('empty_pages')
+        print(f"⚠️ Пустая страница: {url}")
+        return [], validators
+    
+    # Поиск объявлений (адаптировано под текущую верстку Kufar)
+    listings = []
+    next_data = xpaths['next_data'](tree)
+    
+    if next_data:
+        count_layout('next_data_pages')
+        try:
+            data = json.loads(next_data[0])
+            items = data['props']['pageProps']['dehydratedState']['queries'][0]['state']['data']['ads']
+            keyword_list = [w.strip() for w in keywords.lower().split(',') if w.strip()] if keywords else []
+    
+            for item in items:
+                price = item.get('price', 0)
+                price_int = price
+                title = item.get('subject', '').lower()
+                description = item.get('body', '').lower()
                 
-                for item in items:
-                    price = item.get('price', 0)
-                    price_int = price
-                    
-                    # Фильтр по цене
-                    if min_price and price_int < min_price:
-                        continue
-                    if max_price and price_int > max_price:
-                        continue
-                    
-                    # Фильтр по ключевым словам
-                    title = item.get('subject', '').lower()
-                    description = item.get('body', '').lower()
-                    keyword_match = False if keywords else True
-                    
-                    if keywords:
-                        for word in keywords.lower().split(','):
-                            word = word.strip()
-                            if word and (word in title or word in description):
-                                keyword_match = True
-                                break
-                    
-                    if not keyword_match:
-                        continue
-                    
-                    # Анализ рисков мошенничества
-                    full_text = f"{title} {description} {item.get('params', '')}"
-                    risk_analysis = analyze_ad_risk(full_text)
-                    
-                    listings.append({
-                        'id': item['ad_id'],
-                        'title': item['subject'],
-                        'price': f"{price_int} BYN",
-                        'price_int': price_int,
-                        'url': f"https://kufar.by/item/{item['ad_id']}",
-                        'description': description,
-                        'risk_data': risk_analysis
-                    })
-            except Exception as e:
-                print(f"Ошибка парсинга JSON: {e}")
-        else:
-            # Резервный метод парсинга
-            print("Резервный метод парсинга...")
-            cards = soup.find_all('div', class_=re.compile('list-item'))
-            for card in cards[:5]:
-                try:
-                    title_tag = card.find('a', class_=re.compile('title'))
-                    price_tag = card.find('div', class_=re.compile('price'))
-                    link_tag = card.find('a', class_=re.compile('title'))
-                    
-                    if not all([title_tag, price_tag, link_tag]):
-                        continue
-                    
-                    ad_id = link_tag['href'].split('/')[-1].split('?')[0]
-                    title = title_tag.text.strip()
-                    price_text = price_tag.text.replace(' ', '').replace('р.', '').strip()
-                    price_int = int(re.sub(r'[^\d]', '', price_text)) if price_text.isdigit() else 0
-                    price = f"{price_int} BYN"
-                    
-                    # Проверка фильтров
-                    if (min_price and price_int < min_price) or (max_price and price_int > max_price):
-                        continue
-                    
-                    # Анализ рисков мошенничества
-                    risk_analysis = analyze_ad_risk(title)
-                    
-                    listings.append({
-                        'id': ad_id,
-                        'title': title,
-                        'price': price,
-                        'price_int': price_int,
-                        'url': f"https://kufar.by{link_tag['href']}",
-                        'description': "",
-                        'risk_data': risk_analysis
-                    })
-                except Exception as e:
+                # В индекс повторов попадают все объявления страницы, не только прошедшие фильтры
+                repost_of = check_repost(item['ad_id'], title, description, price_int)
+    
+                # Фильтр по цене
+                if min_price and price_int < min_price:
                     continue
-        
-        return listings
+                if max_price and price_int > max_price:
+                    continue
+    
+                # Фильтр по ключевым словам
+                if keyword_list and not any(word in title or word in description for word in keyword_list):
+                    continue
+    
+                # Анализ рисков мошенничества; описание дальше не хранится
+                full_text = f"{title} {description} {item.get('params', '')}"
+                risk_analysis = mark_repost(analyze_ad_risk(full_text), repost_of)
+    
+                listings.append(Listing(item['ad_id'], item['subject'], price_int, risk_analysis))
+        except Exception as e:
+            count_layout('next_data_errors')
+            print(f"Ошибка парсинга JSON: {e}")
+    else:
+        # Резервный метод: все карточки страницы за один проход по дереву
+        count_layout('fallback_pages')
+        cards = xpaths['cards'](tree)
+        broken = 0
+        missing_price = 0
+        seen_ids = set()
+        for card in cards:
+            links = xpaths['link'](card)
+            href = links[0].get('href', '') if links else ''
+            ad_id = href.split('?')[0].rstrip('/').split('/')[-1]
+            if not ad_id:
+                broken += 1
+                continue
+            if ad_id in seen_ids:
+                continue
+            seen_ids.add(ad_id)
+    
+            title = ' '.join(links[0].text_content().split())
+            # Пустая строка — в карточке нет элемента цены (в отличие от «Договорная»)
+            price_text = xpaths['price'](card).strip()
+            if not price_text:
+                missing_price += 1
+            price_int = parse_price(price_text)
+    
+            # Проверка фильтров
+            if (min_price and price_int < min_price) or (max_price and price_int > max_price):
+                continue
+    
+            # Анализ рисков мошенничества; повторы по одному заголовку не ищем — в карточке нет описания
+            risk_analysis = analyze_ad_risk(title)
+    
+            listings.append(Listing(ad_id, title, price_int, risk_analysis))
+    
+        count_layout('cards', len(cards))
+        if broken:
+            count_layout('broken_cards', broken)
+            print(f"⚠️ Верстка изменилась: {broken} из {len(cards)} карточек без ссылки ({url})")
+        if missing_price:
+            count_layout('missing_price', missing_price)
+            print(f"⚠️ Верстка изменилась: {missing_price} из {len(cards)} карточек без цены ({url})")
+        if not cards:
+            count_layout('empty_pages')
+            print(f"⚠️ Ни __NEXT_DATA__, ни карточек на странице: {url}")
+    
+    return listings, validators
+
+def parse_kufar_url(url: str, min_price: int = None, max_price: int = None, keywords: str = None) -> list:
+    """Парсит объявления с Kufar.by с фильтрами и защитой от блокировок"""
+    try:
+        return fetch_listings(url, min_price, max_price, keywords)[0]
     except Exception as e:
         print(f"🔥 Критическая ошибка парсинга: {e}")
         return []
 
+class ParseCache:
+    """Общий кэш результатов парсинга с TTL и объединением одновременных запросов.
+    Валидаторы условного запроса хранятся в записи: 304 подтверждает именно этот результат"""
+
+    def __init__(self, ttl: int = PARSE_CACHE_TTL, max_entries: int = PARSE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # ключ -> (время загрузки, объявления, валидаторы)
+        self.in_flight = {}  # ключ -> Event загрузки, которую уже кто-то выполняет
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _fresh(self, key):
+        """Свежая запись из кэша или None (вызывать под lock)"""
+        entry = self.entries.get(key)
+        if entry and time.time() - entry[0] <= self.ttl:
+            self.entries.move_to_end(key)
+            return entry[1]
+        return None
+
+    def put(self, key, listings: list, validators: tuple = None):
+        """Кладет результат в кэш, вытесняя самые старые записи"""
+        with self.lock:
+            self.entries[key] = (time.time(), listings, validators)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _load(self, key, fetch) -> list:
+        """Загрузка с прошлым результатом ключа: fetch(previous) -> (объявления, валидаторы)"""
+        listings, validators = fetch(self.peek(key))
+        self.put(key, listings, validators)
+        return listings
+
+    def get_or_fetch(self, key, fetch) -> list:
+        """Возвращает свежий результат или загружает его; одинаковые загрузки объединяются"""
+        with self.lock:
+            listings = self._fresh(key)
+            if listings is not None:
+                self.hits += 1
+                return listings
+            
+            event = self.in_flight.get(key)
+            if event is None:
+                event = self.in_flight[key] = threading.Event()
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+                self.coalesced += 1
+        
+        if not owner:
+            # Ждем результат чужой загрузки; если она упала — грузим сами
+            event.wait(timeout=EGRESS_WAIT_TIMEOUT + 30)
+            with self.lock:
+                listings = self._fresh(key)
+            if listings is not None:
+                return listings
+            return self._load(key, fetch)
+        
+        try:
+            return self._load(key, fetch)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            event.set()
+
+    def peek(self, key):
+        """Последние (объявления, валидаторы) ключа независимо от возраста или None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry[1:] if entry else None
+
+    def export(self) -> list:
+        """Записи кэша для снимка состояния"""
+        with self.lock:
+            return [
+                [list(key), fetched_at, [listing_to_row(item) for item in listings], validators]
+                for key, (fetched_at, listings, validators) in self.entries.items()
+            ]
+
+    def load(self, rows: list):
+        """Восстанавливает записи из снимка"""
+        with self.lock:
+            for key, fetched_at, listings, validators in rows:
+                self.entries[tuple(key)] = (fetched_at, [listing_from_row(row) for row in listings],
+                                            tuple(validators) if validators else None)
+
+    def stats(self) -> dict:
+        """Счетчики кэша для метрик"""
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+PARSE_CACHE = ParseCache()
+
+def get_listings(url: str, min_price: int = None, max_price: int = None, keywords: str = None) -> list:
+    """Объявления по ссылке из общего кэша; в сеть идем только за устаревшими"""
+    key = (url, min_price, max_price, keywords)
+    return PARSE_CACHE.get_or_fetch(
+        key,
+        lambda previous: fetch_listings(url, min_price, max_price, keywords, previous=previous)
+    )
+
+def find_ad_data(data, ad_id: int):
+    """Ищет в __NEXT_DATA__ словарь объявления с нужным ad_id (не зависит от вложенности)"""
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if node.get('ad_id') == ad_id and 'subject' in node:
+                return node
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return None
+
+def fetch_ad(ad_id: str, previous: tuple = None) -> tuple:
+    """Загружает страницу объявления: ([Listing] или [] для снятого, валидаторы)"""
+    url = ITEM_URL_PREFIX + ad_id
+    try:
+        response = fetch_page(url, previous[1] if previous else None)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in (404, 410):
+            return [], None
+        raise
+    if response is None:
+        return previous
+    
+    from lxml import html as lxml_html
+    
+    next_data = page_xpaths()['next_data'](lxml_html.document_fromstring(response.text))
+    item = find_ad_data(json.loads(next_data[0]), int(ad_id)) if next_data else None
+    if item is None:
+        count_layout('broken_ad_pages')
+        raise ValueError(f"на странице объявления {ad_id} нет данных объявления")
+    
+    title = item.get('subject', '')
+    description = item.get('body', '')
+    price_int = item.get('price', 0)
+    repost_of = check_repost(ad_id, title.lower(), description.lower(), price_int)
+    risk_analysis = mark_repost(analyze_ad_risk(f"{title} {description}".lower()), repost_of)
+    return [Listing(ad_id, title, price_int, risk_analysis)], response_validators(response)
+
+def get_ad(ad_id: str) -> list:
+    """Объявление из общего кэша: [Listing] или [] для снятого"""
+    key = ('item', ad_id)
+    return PARSE_CACHE.get_or_fetch(key, lambda previous: fetch_ad(ad_id, previous=previous))
+
 def get_price_drops(user_id: int, new_items: list) -> list:
     """Проверка снижения цены для новых объявлений"""
-    conn = sqlite3.connect('kufar_bot.db')
+    conn = get_connection()
     c = conn.cursor()
     alerts = []
     
     try:
         for item in new_items:
-            ad_id = str(item['id'])
-            current_price = item['price_int']
+            ad_id = str(item.id)
+            current_price = item.price_int
             
             # Получаем последнюю цену для этого объявления
             c.execute("""
@@ -279,7 +1016,7 @@ def get_price_drops(user_id: int, new_items: list) -> list:
 
 def save_price_data(user_id: int, ad_id: str, title: str, price: int, url: str):
     """Сохранение данных о цене объявления"""
-    conn = sqlite3.connect('kufar_bot.db')
+    conn = get_connection()
     c = conn.cursor()
     
     try:
@@ -304,11 +1041,355 @@ def save_price_data(user_id: int, ad_id: str, title: str, price: int, url: str):
     finally:
         conn.close()
 
+def price_bucket(price: int) -> int:
+    """Номер корзины гистограммы для цены (логарифмическая шкала)"""
+    return min(int(math.log(max(price, 1), PRICE_BUCKET_BASE)), PRICE_BUCKETS - 1)
+
+def bucket_price(bucket: int) -> int:
+    """Типичная цена корзины — середина ее диапазона"""
+    return int(round(PRICE_BUCKET_BASE ** (bucket + 0.5)))
+
+def histogram_percentiles(histogram: array, quantiles: list) -> list:
+    """Оценка процентилей по гистограмме корзин"""
+    total = sum(histogram)
+    if not total:
+        return [None] * len(quantiles)
+    
+    values = []
+    for q in quantiles:
+        rank = q * (total - 1)
+        cumulative = 0
+        for bucket, count in enumerate(histogram):
+            cumulative += count
+            if cumulative > rank:
+                values.append(bucket_price(bucket))
+                break
+    return values
+
+def encode_varint(value: int) -> bytes:
+    """Zigzag + varint: небольшие приращения занимают 1–2 байта"""
+    value = (value << 1) ^ (value >> 63)
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def decode_series(blob: bytes) -> list:
+    """Распаковка дельта-ряда объявления в [(timestamp, price), ...]"""
+    points = []
+    numbers = []
+    value = shift = 0
+    for byte in blob:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            numbers.append((value >> 1) ^ -(value & 1))
+            value = shift = 0
+    
+    ts = price = 0
+    for dt, dp in zip(numbers[::2], numbers[1::2]):
+        ts += dt
+        price += dp
+        points.append((ts, price))
+    return points
+
+def record_price_observations(url_id: int, items: list):
+    """Обновляет дневные корзины поиска и ряды цен объявлений по результатам проверки"""
+    priced = [item for item in items if item.price_int > 0]
+    if not priced:
+        return
+    
+    now = int(time.time())
+    day = time.strftime('%Y-%m-%d', time.gmtime(now))
+    
+    conn = get_connection()
+    conn.isolation_level = None
+    c = conn.cursor()
+    
+    try:
+        # В дневную корзину объявление попадает один раз в сутки. Учтенные ID лежат в самой строке
+        # корзины, чтобы перезапуски и соседние воркеры не посчитали объявление повторно
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            SELECT count, total, min_price, max_price, histogram, observed FROM search_price_daily
+            WHERE url_id = ? AND day = ?
+        """, (url_id, day))
+        row = c.fetchone()
+        
+        histogram = array('I', bytes(4 * PRICE_BUCKETS))
+        observed = array('q')
+        count, total, min_price, max_price = 0, 0, None, None
+        if row:
+            count, total, min_price, max_price = row[:4]
+            histogram = array('I', row[4])
+            if row[5]:
+                observed.frombytes(row[5])
+        
+        already = set(observed)
+        fresh = {}
+        for item in priced:
+            key = seen_key(item.id)
+            if key not in already:
+                fresh[key] = item.price_int
+        
+        if fresh:
+            prices = list(fresh.values())
+            for price in prices:
+                histogram[price_bucket(price)] += 1
+            observed.extend(fresh)
+            
+            c.execute("""
+                INSERT OR REPLACE INTO search_price_daily
+                (url_id, day, count, total, min_price, max_price, histogram, observed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (url_id, day, count + len(prices), total + sum(prices),
+                  min(prices + ([min_price] if min_price is not None else [])),
+                  max(prices + ([max_price] if max_price is not None else [])),
+                  histogram.tobytes(), observed.tobytes()))
+        
+        # Ряд цены объявления дописывается только при изменении цены
+        ad_ids = list({str(item.id): item for item in priced}.items())
+        placeholders = ','.join('?' * len(ad_ids))
+        c.execute(f"""
+            SELECT ad_id, last_ts, last_price, series FROM ad_price_series
+            WHERE ad_id IN ({placeholders})
+        """, [ad_id for ad_id, _ in ad_ids])
+        known = {row[0]: row[1:] for row in c.fetchall()}
+        
+        inserts = []
+        appends = []
+        for ad_id, item in ad_ids:
+            if ad_id not in known:
+                inserts.append((ad_id, now, now, item.price_int,
+                                encode_varint(now) + encode_varint(item.price_int)))
+            elif known[ad_id][1] != item.price_int:
+                last_ts, last_price, series = known[ad_id]
+                delta = encode_varint(now - last_ts) + encode_varint(item.price_int - last_price)
+                appends.append((series + delta, now, item.price_int, ad_id))
+        
+        c.executemany("""
+            INSERT INTO ad_price_series (ad_id, first_ts, last_ts, last_price, series)
+            VALUES (?, ?, ?, ?, ?)
+        """, inserts)
+        c.executemany("""
+            UPDATE ad_price_series
+            SET series = ?, last_ts = ?, last_price = ?, points = points + 1
+            WHERE ad_id = ?
+        """, appends)
+        c.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def compact_price_stats():
+    """Пакетное обслуживание агрегатов: чистка старых корзин и досчет рядов из price_history"""
+    started = time.monotonic()
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        cutoff = time.strftime('%Y-%m-%d', time.gmtime(time.time() - PRICE_STATS_DAYS * 86400))
+        c.execute("DELETE FROM search_price_daily WHERE day < ?", (cutoff,))
+        # Учтенные ID нужны только текущим суткам
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        c.execute("UPDATE search_price_daily SET observed = NULL WHERE day < ? AND observed IS NOT NULL", (today,))
+        conn.commit()
+        
+        # Ряды для объявлений, известных только по старой истории, строятся одним проходом
+        c.execute("""
+            SELECT h.ad_id, CAST(strftime('%s', h.timestamp) AS INTEGER), h.price
+            FROM price_history h
+            WHERE NOT EXISTS (SELECT 1 FROM ad_price_series s WHERE s.ad_id = h.ad_id)
+            ORDER BY h.ad_id, h.timestamp
+        """)
+        
+        writer = conn.cursor()
+        
+        def write(batch):
+            writer.executemany("""
+                INSERT OR IGNORE INTO ad_price_series (ad_id, first_ts, last_ts, last_price, series, points)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(ad_id, first_ts, last_ts, price, bytes(series), points)
+                  for ad_id, first_ts, last_ts, price, series, points in batch])
+        
+        batch = []
+        current = None
+        for ad_id, ts, price in c:
+            if current is None or current[0] != ad_id:
+                if current:
+                    batch.append(current)
+                current = [ad_id, ts, ts, price, bytearray(encode_varint(ts) + encode_varint(price)), 1]
+            elif price != current[3]:
+                current[4] += encode_varint(ts - current[2]) + encode_varint(price - current[3])
+                current[2], current[3] = ts, price
+                current[5] += 1
+            
+            if len(batch) >= 1000:
+                write(batch)
+                batch = []
+        if current:
+            batch.append(current)
+        write(batch)
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"📈 Агрегаты цен обновлены за {time.monotonic() - started:.1f} с")
+
+def get_search_price_stats(url_id: int, days: int = 30) -> dict:
+    """Медиана, процентили и тренд цен поиска по дневным корзинам"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        since = time.strftime('%Y-%m-%d', time.gmtime(time.time() - days * 86400))
+        c.execute("""
+            SELECT day, count, min_price, max_price, histogram FROM search_price_daily
+            WHERE url_id = ? AND day >= ?
+        """, (url_id, since))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    
+    if not rows:
+        return None
+    
+    week_ago = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 7 * 86400))
+    two_weeks_ago = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 14 * 86400))
+    total = array('I', bytes(4 * PRICE_BUCKETS))
+    this_week = array('I', bytes(4 * PRICE_BUCKETS))
+    last_week = array('I', bytes(4 * PRICE_BUCKETS))
+    for day, count, min_price, max_price, blob in rows:
+        histogram = array('I', blob)
+        target = this_week if day >= week_ago else last_week if day >= two_weeks_ago else None
+        for bucket, value in enumerate(histogram):
+            if value:
+                total[bucket] += value
+                if target is not None:
+                    target[bucket] += value
+    
+    low = min(row[2] for row in rows)
+    high = max(row[3] for row in rows)
+    # Середина корзины может выйти за реальные границы цен
+    p25, median, p75 = [
+        min(max(value, low), high) for value in histogram_percentiles(total, [0.25, 0.5, 0.75])
+    ]
+    trend = None
+    median_now = histogram_percentiles(this_week, [0.5])[0]
+    median_before = histogram_percentiles(last_week, [0.5])[0]
+    if median_now and median_before:
+        trend = round((median_now - median_before) / median_before * 100, 1)
+    
+    return {
+        'ads': sum(row[1] for row in rows),
+        'min': low,
+        'max': high,
+        'p25': p25,
+        'median': median,
+        'p75': p75,
+        'trend': trend
+    }
+
+def get_ad_price_series(ad_id: str) -> list:
+    """История цены объявления [(timestamp, price), ...]"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("SELECT series FROM ad_price_series WHERE ad_id = ?", (ad_id,))
+        row = c.fetchone()
+        return decode_series(row[0]) if row else []
+    finally:
+        conn.close()
+
+def load_lsh_index():
+    """Загружает подписи недавних объявлений в LSH-индекс; повторные вызовы
+    подгружают только подписи, записанные с тех пор другими процессами"""
+    synced_at = time.time()
+    initial = not LSH_INDEX.synced_at
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        if initial:
+            c.execute("""
+                SELECT ad_key, signature, price, seen_at, repost_of FROM ad_signatures
+                WHERE seen_at > ? ORDER BY seen_at
+            """, (synced_at - LSH_INDEX.ttl,))
+        else:
+            c.execute("""
+                SELECT ad_key, signature, price, seen_at, repost_of FROM ad_signatures
+                WHERE stored_at > ? ORDER BY seen_at
+            """, (LSH_INDEX.synced_at - LSH_SYNC_OVERLAP,))
+        for ad_key, blob, price, seen_at, repost_of in c:
+            LSH_INDEX.add(ad_key, blob, price, seen_at, repost_of, persist=False)
+    finally:
+        conn.close()
+    LSH_INDEX.synced_at = synced_at
+    if initial:
+        print(f"♻️ Индекс повторов: {len(LSH_INDEX.ads)} объявлений")
+
+def flush_signatures():
+    """Пакетно сохраняет новые подписи объявлений"""
+    pending = LSH_INDEX.take_pending()
+    if not pending:
+        return
+    
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        stored_at = time.time()
+        c.executemany("""
+            INSERT OR IGNORE INTO ad_signatures (ad_key, signature, price, seen_at, repost_of, stored_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [row + (stored_at,) for row in pending])
+        conn.commit()
+    finally:
+        conn.close()
+
+def prune_signatures():
+    """Удаляет подписи старше срока хранения индекса"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("DELETE FROM ad_signatures WHERE seen_at < ?", (time.time() - LSH_INDEX.ttl,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def daily_maintenance(context: CallbackContext = None):
+    """Суточное обслуживание: агрегаты цен, устаревшие подписи и прочитанные события"""
+    compact_price_stats()
+    prune_signatures()
+    prune_feed()
+
+def get_connection() -> sqlite3.Connection:
+    """Подключение к общей базе с ожиданием блокировок других процессов"""
+    return sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
+
+def ensure_column(c: sqlite3.Cursor, table: str, column: str, definition: str):
+    """Добавляет колонку в существующую таблицу, если ее еще нет"""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 def init_db():
     """Инициализация базы данных со всеми таблицами"""
-    conn = sqlite3.connect('kufar_bot.db')
+    conn = get_connection()
     c = conn.cursor()
     
+    # WAL позволяет воркерам писать, пока бот читает
+    c.execute("PRAGMA journal_mode=WAL")
+    
     # Таблица пользователей
     c.execute('''CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -324,6 +1405,12 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
     )''')
     
+    # Аренда ссылок воркерами
+    ensure_column(c, 'urls', 'due_at', 'REAL DEFAULT 0')
+    ensure_column(c, 'urls', 'lease_owner', 'TEXT')
+    ensure_column(c, 'urls', 'lease_until', 'REAL DEFAULT 0')
+    ensure_column(c, 'urls', 'seen_ids', 'BLOB')
+    
     # Таблица фильтров
     c.execute('''CREATE TABLE IF NOT EXISTS filters (
                 user_id INTEGER PRIMARY KEY,
@@ -333,233 +1420,1530 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
     )''')
     
-    # Таблица истории цен
-    c.execute('''CREATE TABLE IF NOT EXISTS price_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                ad_id TEXT NOT NULL,
-                title TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                url TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-    )''')
+    # Таблица истории цен
+    c.execute('''CREATE TABLE IF NOT EXISTS price_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                ad_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                price INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+    )''')
+    
+    c.execute("CREATE INDEX IF NOT EXISTS idx_price_history_ad ON price_history (user_id, ad_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_urls_user ON urls (user_id, url)")
+    
+    # Дневные корзины цен по каждой ссылке (гистограмма для медианы и процентилей)
+    c.execute('''CREATE TABLE IF NOT EXISTS search_price_daily (
+                url_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                min_price INTEGER NOT NULL,
+                max_price INTEGER NOT NULL,
+                histogram BLOB NOT NULL,
+                PRIMARY KEY (url_id, day)
+    )''')
+    ensure_column(c, 'search_price_daily', 'observed', 'BLOB')  # ID, уже учтенные в корзине за день
+    
+    # Компактные ряды цен объявлений (дельты времени и цены)
+    c.execute('''CREATE TABLE IF NOT EXISTS ad_price_series (
+                ad_id TEXT PRIMARY KEY,
+                first_ts INTEGER NOT NULL,
+                last_ts INTEGER NOT NULL,
+                last_price INTEGER NOT NULL,
+                points INTEGER DEFAULT 1,
+                series BLOB NOT NULL
+    )''')
+    
+    # MinHash-подписи недавних объявлений для поиска повторов
+    c.execute('''CREATE TABLE IF NOT EXISTS ad_signatures (
+                ad_key INTEGER PRIMARY KEY,
+                signature BLOB NOT NULL,
+                price INTEGER NOT NULL,
+                seen_at REAL NOT NULL,
+                repost_of INTEGER
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ad_signatures_seen ON ad_signatures (seen_at)")
+    # Когда подпись попала в БД — по нему воркеры подгружают подписи друг друга
+    ensure_column(c, 'ad_signatures', 'stored_at', 'REAL DEFAULT 0')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ad_signatures_stored ON ad_signatures (stored_at)")
+    
+    # Закладки: одна строка на объявление, сколько бы пользователей за ним ни следили
+    c.execute('''CREATE TABLE IF NOT EXISTS watched_ads (
+                ad_id TEXT PRIMARY KEY,
+                title TEXT,
+                price INTEGER,
+                active INTEGER DEFAULT 1,
+                checked_at REAL,
+                due_at REAL DEFAULT 0,
+                lease_owner TEXT,
+                lease_until REAL DEFAULT 0
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_watched_ads_due ON watched_ads (active, due_at)")
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS watchlist (
+                user_id INTEGER NOT NULL,
+                ad_id TEXT NOT NULL,
+                added_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, ad_id)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_watchlist_ad ON watchlist (ad_id)")
+    
+    # Лента событий объявлений (только дописывается) и отметки ее потребителей
+    c.execute('''CREATE TABLE IF NOT EXISTS ad_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                url_id INTEGER,
+                ad_id TEXT NOT NULL,
+                old_price INTEGER,
+                listing TEXT NOT NULL,
+                created_at REAL NOT NULL
+    )''')
+    # Результат пересмотра риска объявлений стадией risk
+    c.execute('''CREATE TABLE IF NOT EXISTS ad_risk (
+                ad_id TEXT PRIMARY KEY,
+                risk_level INTEGER NOT NULL,
+                reasons TEXT NOT NULL,
+                updated_at REAL NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS feed_checkpoints (
+                stage TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL,
+                updated_at REAL
+    )''')
+    
+    # Таблица статистики циклов проверки
+    c.execute('''CREATE TABLE IF NOT EXISTS cycle_stats (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                finished_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                duration REAL NOT NULL,
+                urls_due INTEGER NOT NULL,
+                urls_polled INTEGER NOT NULL,
+                urls_carried INTEGER NOT NULL,
+                messages_sent INTEGER NOT NULL
+    )''')
+    ensure_column(c, 'cycle_stats', 'max_lag', 'REAL DEFAULT 0')
+    
+    # Очередь уведомлений от воркеров
+    c.execute('''CREATE TABLE IF NOT EXISTS notifications (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                sent_at DATETIME
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifications_pending ON notifications (sent_at, id)")
+    
+    conn.commit()
+    conn.close()
+    print("✅ База данных инициализирована с новыми таблицами")
+
+def add_user(user_id: int, chat_id: int):
+    """Добавление пользователя в БД"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", 
+                 (user_id, chat_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def add_url(user_id: int, url: str):
+    """Добавление ссылки для пользователя"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("INSERT INTO urls (user_id, url) VALUES (?, ?)", 
+                 (user_id, url))
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_user_urls(user_id: int) -> list:
+    """Получение всех ссылок пользователя"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("SELECT id, url, last_id FROM urls WHERE user_id = ?", (user_id,))
+        return c.fetchall()
+    finally:
+        conn.close()
+
+class SeenSet:
+    """Ограниченное кольцо ID объявлений, уже встречавшихся по ссылке"""
+    __slots__ = ('ring', 'members', 'dirty')
+
+    def __init__(self, ids=(), limit: int = SEEN_IDS_LIMIT):
+        self.ring = deque(maxlen=limit)
+        self.members = set()
+        self.dirty = False
+        for key in ids:
+            self._push(key)
+
+    def _push(self, key: int):
+        if len(self.ring) == self.ring.maxlen:
+            self.members.discard(self.ring[0])
+        self.ring.append(key)
+        self.members.add(key)
+
+    def __contains__(self, ad_id) -> bool:
+        return seen_key(ad_id) in self.members
+
+    def __len__(self) -> int:
+        return len(self.ring)
+
+    def add(self, ad_id) -> bool:
+        """Добавляет ID; True, если объявление встретилось впервые"""
+        key = seen_key(ad_id)
+        # Под общей блокировкой: flush_seen_sets читает кольцо и сбрасывает dirty из другого потока
+        with seen_sets_lock:
+            if key in self.members:
+                return False
+            self._push(key)
+            self.dirty = True
+            return True
+
+    def to_blob(self) -> bytes:
+        """Упаковка для колонки urls.seen_ids"""
+        return array('q', self.ring).tobytes()
+
+    @classmethod
+    def from_blob(cls, blob: bytes) -> 'SeenSet':
+        """Распаковка из колонки urls.seen_ids"""
+        ids = array('q')
+        if blob:
+            ids.frombytes(blob)
+        return cls(ids)
+
+def seen_key(ad_id) -> int:
+    """Числовой ключ объявления: сам ID или crc32 для нечисловых"""
+    try:
+        return int(ad_id)
+    except (TypeError, ValueError):
+        return zlib.crc32(str(ad_id).encode())
+
+def load_seen_sets(url_ids: list = None):
+    """Загружает множества просмотренных объявлений из БД (все или указанные ссылки)"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        if url_ids is None:
+            c.execute("SELECT id, seen_ids FROM urls WHERE seen_ids IS NOT NULL")
+        else:
+            placeholders = ','.join('?' * len(url_ids))
+            c.execute(f"SELECT id, seen_ids FROM urls WHERE id IN ({placeholders})", url_ids)
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    
+    with seen_sets_lock:
+        for url_id, blob in rows:
+            seen_sets[url_id] = SeenSet.from_blob(blob)
+
+def get_seen_set(url_id: int) -> SeenSet:
+    """Множество просмотренных объявлений ссылки"""
+    with seen_sets_lock:
+        seen = seen_sets.get(url_id)
+        if seen is None:
+            seen = seen_sets[url_id] = SeenSet()
+        return seen
+
+def forget_seen_sets(url_ids: list):
+    """Выгружает множества из памяти (воркер держит только арендованные ссылки)"""
+    with seen_sets_lock:
+        for url_id in url_ids:
+            seen_sets.pop(url_id, None)
+
+def flush_seen_sets():
+    """Пакетно сохраняет измененные множества в БД"""
+    with seen_sets_lock:
+        dirty = [(seen.to_blob(), url_id) for url_id, seen in seen_sets.items() if seen.dirty]
+        for seen in seen_sets.values():
+            seen.dirty = False
+    
+    if not dirty:
+        return
+    
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.executemany("UPDATE urls SET seen_ids = ? WHERE id = ?", dirty)
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_all_users() -> list:
+    """Получение всех пользователей"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("SELECT user_id FROM users")
+        return c.fetchall()
+    finally:
+        conn.close()
+
+def get_user_filters(user_id: int) -> tuple:
+    """Получение фильтров пользователя"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("SELECT * FROM filters WHERE user_id = ?", (user_id,))
+        return c.fetchone()
+    finally:
+        conn.close()
+
+def update_filters(user_id: int, min_price: int, max_price: int, keywords: str):
+    """Обновление фильтров пользователя"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        # Проверяем, существуют ли фильтры
+        c.execute("SELECT 1 FROM filters WHERE user_id = ?", (user_id,))
+        exists = c.fetchone()
+        
+        if exists:
+            c.execute("""UPDATE filters SET 
+                        min_price = ?, max_price = ?, keywords = ?
+                        WHERE user_id = ?""",
+                     (min_price, max_price, keywords, user_id))
+        else:
+            c.execute("""INSERT INTO filters 
+                        (user_id, min_price, max_price, keywords) 
+                        VALUES (?, ?, ?, ?)""",
+                     (user_id, min_price, max_price, keywords))
+        
+        conn.commit()
+    finally:
+        conn.close()
+
+def delete_all_urls(user_id: int):
+    """Удаление всех ссылок пользователя"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("DELETE FROM urls WHERE user_id = ?", (user_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def check_url(user_id: int, url_id: int, url: str, last_id: int,
+              min_price: int = None, max_price: int = None, keywords: str = None) -> int:
+    """Проверка одной ссылки: новые объявления и снижения цен пишутся в ленту событий"""
+    items = get_listings(url, min_price, max_price, keywords)
+    record_price_observations(url_id, items)
+    
+    # Выдача не изменилась с прошлой проверки — новых объявлений и снижений нет
+    fingerprint = zlib.crc32(repr([(item.id, item.price_int) for item in items]).encode())
+    if url_fingerprints.get(url_id) == fingerprint:
+        return 0
+    
+    # Проверка новых объявлений по множеству уже виденных ID
+    seen = get_seen_set(url_id)
+    # Ссылки со старым last_id: объявления не новее него считаем уже виденными
+    seed_last_id = last_id if not len(seen) else 0
+    new_items = list({
+        seen_key(item.id): item for item in items
+        if item.id not in seen and not (seed_last_id and seen_key(item.id) <= seed_last_id)
+    }.values())
+    
+    # Проверка снижения цены для всех объявлений
+    price_drops = get_price_drops(user_id, items)
+    
+    # Сообщения, история цен и риск строятся стадиями ленты
+    events = [('new', url_id, item, None) for item in new_items]
+    events += [('price', url_id, drop['item'], drop['old_price']) for drop in price_drops]
+    append_events(events)
+    
+    # Состояние ссылки меняется только после записи событий: при сбое ленты
+    # следующая проверка снова найдет те же новые объявления
+    for item in items:
+        seen.add(item.id)
+    with crawl_state_lock:
+        url_fingerprints[url_id] = fingerprint
+    return len(events)
+
+def append_events(events: list):
+    """Дописывает события [(вид, url_id, Listing, прежняя цена), ...] в ленту"""
+    if not events:
+        return
+    
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        now = time.time()
+        c.executemany("""
+            INSERT INTO ad_events (kind, url_id, ad_id, old_price, listing, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(kind, url_id, str(item.id), old_price,
+               json.dumps(listing_to_row(item), ensure_ascii=False), now)
+              for kind, url_id, item, old_price in events])
+        conn.commit()
+    finally:
+        conn.close()
+
+def consume_feed(stage: str, handler, limit: int = FEED_BATCH) -> tuple:
+    """Обрабатывает следующую пачку событий стадии; возвращает (событий, результатов).
+    Результаты стадии и ее отметка фиксируются одной транзакцией: сбой не теряет и не повторяет события"""
+    conn = get_connection()
+    conn.isolation_level = None
+    c = conn.cursor()
+    
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT seq FROM feed_checkpoints WHERE stage = ?", (stage,))
+        row = c.fetchone()
+        c.execute("""
+            SELECT seq, kind, url_id, old_price, listing FROM ad_events
+            WHERE seq > ? ORDER BY seq LIMIT ?
+        """, (row[0] if row else 0, limit))
+        events = [(seq, kind, url_id, old_price, listing_from_row(json.loads(listing)))
+                  for seq, kind, url_id, old_price, listing in c.fetchall()]
+        if not events:
+            c.execute("ROLLBACK")
+            return 0, 0
+        
+        produced = handler(c, events)
+        c.execute("""
+            INSERT INTO feed_checkpoints (stage, seq, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (stage) DO UPDATE SET seq = excluded.seq, updated_at = excluded.updated_at
+        """, (stage, events[-1][0], time.time()))
+        c.execute("COMMIT")
+        return len(events), produced
+    except Exception:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def format_new_ads(items: list) -> str:
+    """Сообщение о новых объявлениях одной ссылки"""
+    message = "✨ *Новые объявления*:\n\n"
+    for item in items[:3]:  # Максимум 3 объявления за раз
+        risk_message = get_risk_message(item.risk_data)
+        
+        message += f"💰 *{item.price}*\n"
+        message += f"📌 [{item.title}]({item.url})\n"
+        
+        if risk_message:
+            message += f"\n{risk_message}\n"
+        
+        message += "\n"
+    return message
+
+def format_price_drops(drops: list) -> str:
+    """Сообщение о снижении цен [(Listing, прежняя цена), ...]"""
+    message = "📉 *Цены упали!*\n\n"
+    for item, old_price in drops[:3]:  # Максимум 3 уведомления
+        risk_message = get_risk_message(item.risk_data)
+        drop_amount = old_price - item.price_int
+        
+        message += f"📉 Снижение на *{round(drop_amount / old_price * 100, 1)}%* ({drop_amount} BYN)!\n"
+        message += f"💰 Было: *{old_price} BYN*\n"
+        message += f"💰 Стало: *{item.price}*\n"
+        message += f"📌 [{item.title}]({item.url})\n"
+        
+        if risk_message:
+            message += f"\n{risk_message}\n"
+        
+        message += "\n"
+    return message
+
+def format_watch_event(kind: str, item: Listing, old_price: int) -> str:
+    """Сообщение по объявлению из закладок; None — событие не интересно пользователю"""
+    if kind == 'gone':
+        return f"{WATCH_TEXT}\n\n🚫 Объявление снято с продажи: [{item.title}]({item.url})"
+    if kind != 'price' or not old_price or not item.price_int or item.price_int >= old_price:
+        return None
+    
+    drop_amount = old_price - item.price_int
+    message = f"{WATCH_TEXT}\n\n📉 Снижение на *{round(drop_amount / old_price * 100, 1)}%* ({drop_amount} BYN)!\n"
+    message += f"💰 Было: *{old_price} BYN*\n"
+    message += f"💰 Стало: *{item.price}*\n"
+    message += f"📌 [{item.title}]({item.url})\n"
+    risk_message = get_risk_message(item.risk_data)
+    if risk_message:
+        message += f"\n{risk_message}\n"
+    return message
+
+def notify_stage(c: sqlite3.Cursor, events: list) -> int:
+    """Стадия уведомлений: подбирает получателей событий и ставит сообщения в очередь"""
+    url_ids = {url_id for _, _, url_id, _, _ in events if url_id is not None}
+    watched = {item.id for _, _, url_id, _, item in events if url_id is None}
+    
+    # Получатели на момент обработки: удаленные ссылки и закладки уже не уведомляются
+    owners = {}
+    if url_ids:
+        c.execute(f"SELECT id, user_id FROM urls WHERE id IN ({','.join('?' * len(url_ids))})", list(url_ids))
+        owners = dict(c.fetchall())
+    watchers = defaultdict(list)
+    if watched:
+        c.execute(f"SELECT ad_id, user_id FROM watchlist WHERE ad_id IN ({','.join('?' * len(watched))})",
+                  list(watched))
+        for ad_id, user_id in c.fetchall():
+            watchers[ad_id].append(user_id)
+    
+    # События одной ссылки объединяются в сообщения, как и при проверке
+    by_url = OrderedDict()
+    notifications = []
+    for _, kind, url_id, old_price, item in events:
+        if url_id is None:
+            text = format_watch_event(kind, item, old_price)
+            if text:
+                notifications.extend((user_id, text) for user_id in watchers[item.id])
+        elif url_id in owners:
+            by_url.setdefault((url_id, kind), []).append((item, old_price))
+    
+    for (url_id, kind), group in by_url.items():
+        if kind == 'new':
+            text = format_new_ads([item for item, _ in group])
+        else:
+            text = format_price_drops(group)
+        notifications.append((owners[url_id], text))
+    
+    c.executemany("INSERT INTO notifications (user_id, text) VALUES (?, ?)", notifications)
+    return len(notifications)
+
+def history_stage(c: sqlite3.Cursor, events: list) -> int:
+    """Стадия истории цен: новые объявления и изменения цен поисков пишутся в price_history"""
+    url_ids = {url_id for _, _, url_id, _, _ in events if url_id is not None}
+    if not url_ids:
+        return 0
+    c.execute(f"SELECT id, user_id FROM urls WHERE id IN ({','.join('?' * len(url_ids))})", list(url_ids))
+    owners = dict(c.fetchall())
+    
+    saved = 0
+    for _, kind, url_id, _, item in events:
+        if url_id not in owners or kind not in ('new', 'price'):
+            continue
+        
+        # Сохраняем только если цена изменилась или объявление новое
+        c.execute("""
+            SELECT price FROM price_history
+            WHERE user_id = ? AND ad_id = ?
+            ORDER BY timestamp DESC LIMIT 1
+        """, (owners[url_id], item.id))
+        last_record = c.fetchone()
+        if not last_record or last_record[0] != item.price_int:
+            c.execute("""
+                INSERT INTO price_history (user_id, ad_id, title, price, url)
+                VALUES (?, ?, ?, ?, ?)
+            """, (owners[url_id], item.id, item.title, item.price_int, item.url))
+            saved += 1
+    return saved
+
+def risk_stage(c: sqlite3.Cursor, events: list) -> int:
+    """Стадия пересмотра риска: цена против медианы поиска и резкие снижения.
+    Повышенный уровень сохраняется в ad_risk, владельцу ссылки уходит предупреждение"""
+    url_ids = {url_id for _, kind, url_id, _, _ in events if url_id is not None and kind in ('new', 'price')}
+    if not url_ids:
+        return 0
+    c.execute(f"SELECT id, user_id FROM urls WHERE id IN ({','.join('?' * len(url_ids))})", list(url_ids))
+    owners = dict(c.fetchall())
+    
+    medians = {}
+    rescored = 0
+    warnings = []
+    for _, kind, url_id, old_price, item in events:
+        if url_id not in owners or kind not in ('new', 'price') or not item.price_int:
+            continue
+        
+        if url_id not in medians:
+            stats = get_search_price_stats(url_id)
+            medians[url_id] = stats['median'] if stats and stats['ads'] >= RISK_MIN_ADS else None
+        median = medians[url_id]
+        
+        reasons = []
+        if median and item.price_int < median * RISK_LOW_PRICE_RATIO:
+            reasons.append(f"цена намного ниже медианы поиска ({median} BYN)")
+        if kind == 'price' and old_price and item.price_int < old_price * (1 - RISK_DROP_RATIO):
+            reasons.append(f"цену резко снизили: {old_price} → {item.price_int} BYN")
+        if not reasons:
+            continue
+        
+        c.execute("SELECT risk_level FROM ad_risk WHERE ad_id = ?", (str(item.id),))
+        row = c.fetchone()
+        known_level = max(row[0], item.risk_level) if row else item.risk_level
+        level = min(item.risk_level + len(reasons), 2)
+        if level <= known_level:
+            continue
+        
+        c.execute("""
+            INSERT INTO ad_risk (ad_id, risk_level, reasons, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (ad_id) DO UPDATE SET
+                risk_level = excluded.risk_level, reasons = excluded.reasons, updated_at = excluded.updated_at
+        """, (str(item.id), level, json.dumps(reasons, ensure_ascii=False), time.time()))
+        rescored += 1
+        
+        risk_message = get_risk_message(dict(item.risk_data, risk_level=level))
+        text = f"🔎 *Риск объявления пересмотрен*\n\n📌 [{item.title}]({item.url})\n"
+        text += "".join(f"• {reason}\n" for reason in reasons)
+        text += f"\n{risk_message}\n"
+        warnings.append((owners[url_id], text))
+    
+    c.executemany("INSERT INTO notifications (user_id, text) VALUES (?, ?)", warnings)
+    return rescored
+
+# Потребители ленты: каждая стадия идет от своей отметки и может работать в отдельном процессе
+FEED_CONSUMERS = {
+    'notify': notify_stage,
+    'history': history_stage,
+    'risk': risk_stage
+}
+
+def run_feed_stages(stages: list = None) -> dict:
+    """Прогоняет стадии до конца ленты; возвращает {стадия: результатов}"""
+    produced = {}
+    for stage in stages or FEED_STAGES:
+        produced[stage] = 0
+        while True:
+            try:
+                count, outputs = consume_feed(stage, FEED_CONSUMERS[stage])
+            except Exception as e:
+                # Отметка не сдвинулась: пачка будет обработана повторно при следующем запуске
+                print(f"Ошибка стадии ленты {stage}: {e}")
+                break
+            produced[stage] += outputs
+            if count < FEED_BATCH:
+                break
+    return produced
+
+def get_feed_lag() -> dict:
+    """Сколько событий ленты ждет каждая стадия"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("SELECT COALESCE(MAX(seq), 0) FROM ad_events")
+        last_seq = c.fetchone()[0]
+        c.execute("SELECT stage, seq FROM feed_checkpoints")
+        checkpoints = dict(c.fetchall())
+        return {stage: max(last_seq - checkpoints.get(stage, 0), 0) for stage in FEED_CONSUMERS}
+    finally:
+        conn.close()
+
+def prune_feed():
+    """Удаляет события, которые прочитали все стадии и которые старше срока хранения"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        # Стадия без отметки еще ничего не прочитала: для нее граница — 0
+        c.execute("SELECT stage, seq FROM feed_checkpoints")
+        checkpoints = dict(c.fetchall())
+        min_seq = min(checkpoints.get(stage, 0) for stage in FEED_CONSUMERS)
+        c.execute("""
+            DELETE FROM ad_events
+            WHERE created_at < ? AND seq <= ?
+        """, (time.time() - FEED_RETENTION_DAYS * 86400, min_seq))
+        conn.commit()
+        print(f"🧹 Лента событий: удалено {c.rowcount} старых событий")
+    finally:
+        conn.close()
+
+WATCH_REPLIES = {
+    'added': "👁 Добавлено в закладки: сообщу о снижении цены и снятии с продажи",
+    'exists': "👁 Объявление уже в закладках",
+    'limit': f"❌ В закладках уже {WATCH_LIMIT} объявлений — уберите ненужные через /watchlist"
+}
+AD_LINK_RE = re.compile(r'\[([^\]]*)\]\(' + re.escape(ITEM_URL_PREFIX) + r'(\d+)\)')
+
+def watch_keyboard(text: str):
+    """Кнопки закладок для объявлений из текста уведомления"""
+    ads = {}
+    for title, ad_id in AD_LINK_RE.findall(text or ''):
+        ads.setdefault(ad_id, title)
+    if not ads:
+        return None
+    
+    # В уведомлении по закладке — кнопка снятия, в остальных — добавления
+    action, label = ('unwatch', "✖️ Не следить") if text.startswith(WATCH_TEXT) else ('watch', "👁 Следить")
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{label}: {title[:30]}", callback_data=f"{action}:{ad_id}")]
+        for ad_id, title in ads.items()
+    ])
+
+def send_user_messages(bot, user_id: int, messages: list) -> int:
+    """Отправка сообщений пользователю, возвращает число доставленных"""
+    sent = 0
+    for msg in messages:
+        try:
+            bot.send_message(
+                chat_id=user_id,
+                text=msg,
+                parse_mode='Markdown',
+                disable_web_page_preview=True,
+                reply_markup=watch_keyboard(msg)
+            )
+            sent += 1
+            time.sleep(1)  # Задержка между сообщениями
+        except Exception as e:
+            print(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+    return sent
+
+class FairScheduler:
+    """Справедливая очередь: ссылки пользователей чередуются по кругу с лимитами на цикл"""
+
+    def __init__(self, jobs: list, carried: list = (), url_budget: int = USER_URL_BUDGET,
+                 request_budget: int = USER_REQUEST_BUDGET, lag: dict = None):
+        carried_pos = {url_id: pos for pos, url_id in enumerate(carried)}
+        lag = lag or {}
+
+        queues = {}
+        for job in jobs:
+            queues.setdefault(job[0], []).append(job)
+
+        # Перенесенные ссылки первыми, дальше — давно не проверенные
+        for user_jobs in queues.values():
+            user_jobs.sort(key=lambda job: (carried_pos.get(job[1], len(carried_pos)),
+                                            url_last_polled.get(job[1], 0)))
+
+        # Первыми обслуживаются пользователи, которые сильнее отстали
+        self.queues = OrderedDict(
+            (user_id, deque(queues[user_id]))
+            for user_id in sorted(queues, key=lambda user_id: -lag.get(user_id, 0))
+        )
+        self.url_budget = url_budget
+        self.request_budget = request_budget
+        self.urls_used = defaultdict(int)
+        self.requests_used = defaultdict(int)
+        self.deferred = []
+
+    def has_budget(self, user_id: int) -> bool:
+        """Остался ли у пользователя лимит в этом цикле"""
+        return (self.urls_used[user_id] < self.url_budget
+                and self.requests_used[user_id] < self.request_budget)
+
+    def __iter__(self):
+        while self.queues:
+            for user_id in list(self.queues):
+                queue = self.queues[user_id]
+                if not self.has_budget(user_id):
+                    # Лимит исчерпан — остаток ждет следующего цикла
+                    self.deferred.extend(queue)
+                    del self.queues[user_id]
+                    continue
+
+                job = queue.popleft()
+                if not queue:
+                    del self.queues[user_id]
+                self.urls_used[user_id] += 1
+                yield job
+
+    def charge(self, user_id: int, request_count: int):
+        """Списывает сделанные запросы с лимита пользователя"""
+        self.requests_used[user_id] += request_count
+
+    def pending(self) -> list:
+        """Ссылки, которые не успели проверить в этом цикле"""
+        remaining = [job for queue in self.queues.values() for job in queue]
+        return self.deferred + remaining
+
+def update_user_lag(jobs: list):
+    """Пересчитывает отставание пользователей от интервала проверки"""
+    now = time.time()
+    lag = {}
+    for job in jobs:
+        user_id, url_id = job[0], job[1]
+        # Новая ссылка считается подошедшей к проверке с момента появления
+        with crawl_state_lock:
+            last_polled = url_last_polled.setdefault(url_id, now - CHECK_INTERVAL)
+        lag[user_id] = max(lag.get(user_id, 0), now - last_polled - CHECK_INTERVAL)
+    
+    user_lag.clear()
+    user_lag.update({user_id: round(max(value, 0), 1) for user_id, value in lag.items()})
+
+def get_user_lag_from_db() -> dict:
+    """Отставание пользователей по срокам аренды (режим воркеров)"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        now = time.time()
+        c.execute("""
+            SELECT user_id, MAX(? - due_at) FROM urls
+            WHERE due_at > 0 AND due_at <= ?
+            GROUP BY user_id
+        """, (now, now))
+        return {user_id: round(lag, 1) for user_id, lag in c.fetchall()}
+    finally:
+        conn.close()
+
+def get_due_urls() -> list:
+    """Все ссылки к проверке вместе с фильтрами их владельцев"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("""
+            SELECT u.user_id, u.id, u.url, u.last_id, f.min_price, f.max_price, f.keywords
+            FROM urls u
+            LEFT JOIN filters f ON f.user_id = u.user_id
+            ORDER BY u.user_id, u.id
+        """)
+        return c.fetchall()
+    finally:
+        conn.close()
+
+def save_cycle_stats(stats: dict):
+    """Сохранение статистики цикла проверки"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("""
+            INSERT INTO cycle_stats (duration, urls_due, urls_polled, urls_carried, messages_sent, max_lag)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (stats['duration'], stats['urls_due'], stats['urls_polled'],
+              stats['urls_carried'], stats['messages_sent'], stats['max_lag']))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_cycle(bot) -> dict:
+    """Один цикл проверки ссылок в пределах CYCLE_BUDGET секунд"""
+    global carry_over_ids, last_cycle_started
+    started = time.monotonic()
+    deadline = started + CYCLE_BUDGET
+    last_cycle_started = time.time()
+    
+    jobs = get_due_urls()
+    update_user_lag(jobs)
+    scheduler = FairScheduler(jobs, carried=carry_over_ids, lag=user_lag)
+    
+    polled = 0
+    events = 0
+    for user_id, url_id, url, last_id, min_price, max_price, keywords in scheduler:
+        if time.monotonic() >= deadline:
+            scheduler.deferred.append((user_id, url_id, url, last_id, min_price, max_price, keywords))
+            break
+        
+        polled += 1
+        requests_before = requests_made()
+        try:
+            events += check_url(user_id, url_id, url, last_id or 0, min_price, max_price, keywords)
+        except Exception as e:
+            print(f"Ошибка при обработке URL {url} для пользователя {user_id}: {e}")
+        finally:
+            scheduler.charge(user_id, requests_made() - requests_before)
+            with crawl_state_lock:
+                url_last_polled[url_id] = time.time()
+    
+    # Закладки: не больше WATCH_BATCH запросов за цикл, сколько бы объявлений ни отслеживалось
+    if time.monotonic() < deadline:
+        try:
+            events += refresh_watched_ads('inline')
+        except Exception as e:
+            print(f"Ошибка обновления закладок: {e}")
+    
+    # Стадии ленты превращают события в уведомления; неотправленные останутся в очереди
+    run_feed_stages()
+    messages_sent = deliver_pending(bot)
+    
+    carry_over_ids = [job[1] for job in scheduler.pending()]
+    flush_seen_sets()
+    flush_signatures()
+    
+    stats = {
+        'duration': round(time.monotonic() - started, 1),
+        'urls_due': len(jobs),
+        'urls_polled': polled,
+        'urls_carried': len(carry_over_ids),
+        'events': events,
+        'messages_sent': messages_sent,
+        'coverage': round(polled / len(jobs), 3) if jobs else 1.0,
+        'max_lag': max(user_lag.values(), default=0)
+    }
+    return stats
+
+def send_periodic_updates(context: CallbackContext):
+    """Автоматическая проверка новых объявлений и снижения цен (интервал 6 минут)"""
+    # Новый цикл не стартует, пока не закончился предыдущий
+    if not cycle_lock.acquire(blocking=False):
+        print("⏭️ Предыдущий цикл проверки еще идет, пропускаем запуск")
+        return
+    
+    try:
+        stats = run_cycle(context.bot)
+        cycle_history.append(stats)
+        save_cycle_stats(stats)
+        print(
+            f"🔁 Цикл завершен за {stats['duration']} с: проверено {stats['urls_polled']}/{stats['urls_due']} ссылок, "
+            f"перенесено {stats['urls_carried']}"
+        )
+    except Exception as e:
+        print(f"Ошибка цикла проверки: {e}")
+    finally:
+        cycle_lock.release()
+
+def claim_due_urls(worker_id: str, limit: int, lease_seconds: int) -> list:
+    """Берет в аренду ссылки, срок проверки которых наступил"""
+    conn = get_connection()
+    conn.isolation_level = None
+    c = conn.cursor()
     
-    conn.commit()
-    conn.close()
-    print("✅ База данных инициализирована с новыми таблицами")
+    try:
+        # BEGIN IMMEDIATE не дает двум воркерам выбрать одни и те же строки
+        c.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        # Ссылки пользователей чередуются: сначала по одной самой старой у каждого
+        c.execute("""
+            SELECT user_id, id, url, last_id, min_price, max_price, keywords FROM (
+                SELECT u.user_id, u.id, u.url, u.last_id, f.min_price, f.max_price, f.keywords, u.due_at,
+                       ROW_NUMBER() OVER (PARTITION BY u.user_id ORDER BY u.due_at) AS user_rank
+                FROM urls u
+                LEFT JOIN filters f ON f.user_id = u.user_id
+                WHERE u.due_at <= ? AND u.lease_until <= ?
+            )
+            WHERE user_rank <= ?
+            ORDER BY user_rank, due_at
+            LIMIT ?
+        """, (now, now, USER_URL_BUDGET, limit))
+        jobs = c.fetchall()
+        
+        c.executemany(
+            "UPDATE urls SET lease_owner = ?, lease_until = ? WHERE id = ?",
+            [(worker_id, now + lease_seconds, job[1]) for job in jobs]
+        )
+        c.execute("COMMIT")
+        return jobs
+    except Exception:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
 
-def add_user(user_id: int, chat_id: int):
-    """Добавление пользователя в БД"""
-    conn = sqlite3.connect('kufar_bot.db')
+def complete_url(worker_id: str, url_id: int):
+    """Снимает аренду и назначает следующую проверку ссылки"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        c.execute("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", 
-                 (user_id, chat_id))
+        c.execute("""
+            UPDATE urls SET due_at = ?, lease_owner = NULL, lease_until = 0
+            WHERE id = ? AND lease_owner = ?
+        """, (time.time() + CHECK_INTERVAL, url_id, worker_id))
         conn.commit()
     finally:
         conn.close()
 
-def add_url(user_id: int, url: str):
-    """Добавление ссылки для пользователя"""
-    conn = sqlite3.connect('kufar_bot.db')
+def release_leases(worker_id: str):
+    """Возвращает все ссылки воркера в очередь (при остановке)"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        c.execute("INSERT INTO urls (user_id, url) VALUES (?, ?)", 
-                 (user_id, url))
+        c.execute("UPDATE urls SET lease_owner = NULL, lease_until = 0 WHERE lease_owner = ?", (worker_id,))
+        c.execute("UPDATE watched_ads SET lease_owner = NULL, lease_until = 0 WHERE lease_owner = ?", (worker_id,))
         conn.commit()
     finally:
         conn.close()
 
-def get_user_urls(user_id: int) -> list:
-    """Получение всех ссылок пользователя"""
-    conn = sqlite3.connect('kufar_bot.db')
+def watch_ad(user_id: int, ad_id: str) -> str:
+    """Добавляет объявление в закладки: 'added', 'exists' или 'limit'"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        c.execute("SELECT id, url, last_id FROM urls WHERE user_id = ?", (user_id,))
-        return c.fetchall()
+        c.execute("SELECT 1 FROM watchlist WHERE user_id = ? AND ad_id = ?", (user_id, ad_id))
+        if c.fetchone():
+            return 'exists'
+        c.execute("SELECT COUNT(*) FROM watchlist WHERE user_id = ?", (user_id,))
+        if c.fetchone()[0] >= WATCH_LIMIT:
+            return 'limit'
+        
+        c.execute("INSERT INTO watchlist (user_id, ad_id) VALUES (?, ?)", (user_id, ad_id))
+        # Новое объявление проверяется в ближайшем цикле; уже отслеживаемое — по своему графику
+        c.execute("INSERT OR IGNORE INTO watched_ads (ad_id) VALUES (?)", (ad_id,))
+        c.execute("UPDATE watched_ads SET active = 1 WHERE ad_id = ? AND active = 0", (ad_id,))
+        conn.commit()
+        return 'added'
     finally:
         conn.close()
 
-def update_last_id(user_id: int, url_id: int, last_id: int):
-    """Обновление последнего ID объявления для ссылки"""
-    conn = sqlite3.connect('kufar_bot.db')
+def unwatch_ad(user_id: int, ad_id: str) -> bool:
+    """Убирает объявление из закладок; ни за кем не закрепленное перестает обновляться"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        c.execute("UPDATE urls SET last_id = ? WHERE id = ? AND user_id = ?", 
-                 (last_id, url_id, user_id))
+        c.execute("DELETE FROM watchlist WHERE user_id = ? AND ad_id = ?", (user_id, ad_id))
+        removed = c.rowcount > 0
+        c.execute("""
+            DELETE FROM watched_ads
+            WHERE ad_id = ? AND NOT EXISTS (SELECT 1 FROM watchlist WHERE ad_id = ?)
+        """, (ad_id, ad_id))
         conn.commit()
+        return removed
     finally:
         conn.close()
 
-def get_all_users() -> list:
-    """Получение всех пользователей"""
-    conn = sqlite3.connect('kufar_bot.db')
+def get_user_watchlist(user_id: int) -> list:
+    """Закладки пользователя: [(ad_id, title, price, active), ...]"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        c.execute("SELECT user_id FROM users")
+        c.execute("""
+            SELECT w.ad_id, a.title, a.price, a.active FROM watchlist w
+            JOIN watched_ads a ON a.ad_id = w.ad_id
+            WHERE w.user_id = ?
+            ORDER BY w.added_at
+        """, (user_id,))
         return c.fetchall()
     finally:
         conn.close()
 
-def get_user_filters(user_id: int) -> tuple:
-    """Получение фильтров пользователя"""
-    conn = sqlite3.connect('kufar_bot.db')
+def claim_watched_ads(owner: str, limit: int, lease_seconds: int) -> list:
+    """Берет в аренду самые давно обновленные объявления из закладок"""
+    conn = get_connection()
+    conn.isolation_level = None
     c = conn.cursor()
     
     try:
-        c.execute("SELECT * FROM filters WHERE user_id = ?", (user_id,))
-        return c.fetchone()
+        c.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        c.execute("""
+            SELECT ad_id, title, price FROM watched_ads
+            WHERE active = 1 AND due_at <= ? AND lease_until <= ?
+            ORDER BY due_at
+            LIMIT ?
+        """, (now, now, limit))
+        ads = c.fetchall()
+        
+        c.executemany(
+            "UPDATE watched_ads SET lease_owner = ?, lease_until = ? WHERE ad_id = ?",
+            [(owner, now + lease_seconds, ad[0]) for ad in ads]
+        )
+        c.execute("COMMIT")
+        return ads
+    except Exception:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
     finally:
         conn.close()
 
-def update_filters(user_id: int, min_price: int, max_price: int, keywords: str):
-    """Обновление фильтров пользователя"""
-    conn = sqlite3.connect('kufar_bot.db')
+def complete_watched_ad(owner: str, ad_id: str, listing: Listing = None, active: bool = True):
+    """Сохраняет результат обновления и назначает следующую проверку объявления"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        # Проверяем, существуют ли фильтры
-        c.execute("SELECT 1 FROM filters WHERE user_id = ?", (user_id,))
-        exists = c.fetchone()
+        now = time.time()
+        if listing is not None:
+            c.execute("UPDATE watched_ads SET title = ?, price = ?, checked_at = ? WHERE ad_id = ?",
+                      (listing.title, listing.price_int, now, ad_id))
+        c.execute("""
+            UPDATE watched_ads SET active = ?, due_at = ?, lease_owner = NULL, lease_until = 0
+            WHERE ad_id = ? AND lease_owner = ?
+        """, (int(active), now + WATCH_INTERVAL, ad_id, owner))
+        conn.commit()
+    finally:
+        conn.close()
+
+def refresh_watched_ads(owner: str, limit: int = WATCH_BATCH) -> int:
+    """Обновляет пачку объявлений из закладок; изменения цен и снятия пишутся в ленту событий"""
+    events = []
+    for ad_id, title, price in claim_watched_ads(owner, limit, LEASE_SECONDS):
+        try:
+            found = get_ad(ad_id)
+        except Exception as e:
+            print(f"Ошибка обновления объявления {ad_id} из закладок: {e}")
+            complete_watched_ad(owner, ad_id)
+            continue
         
-        if exists:
-            c.execute("""UPDATE filters SET 
-                        min_price = ?, max_price = ?, keywords = ?
-                        WHERE user_id = ?""",
-                     (min_price, max_price, keywords, user_id))
-        else:
-            c.execute("""INSERT INTO filters 
-                        (user_id, min_price, max_price, keywords) 
-                        VALUES (?, ?, ?, ?)""",
-                     (user_id, min_price, max_price, keywords))
+        if not found:
+            complete_watched_ad(owner, ad_id, active=False)
+            events.append(('gone', None, Listing(ad_id, title or ad_id, price or 0), price))
+            continue
         
-        conn.commit()
+        item = found[0]
+        complete_watched_ad(owner, ad_id, item)
+        # Первое обновление только запоминает цену
+        if price and item.price_int != price:
+            events.append(('price', None, item, price))
+    
+    append_events(events)
+    return len(events)
+
+def get_pending_notifications(after_id: int = 0, limit: int = 50) -> list:
+    """Неотправленные уведомления в порядке поступления (с ID больше after_id)"""
+    conn = get_connection()
+    c = conn.cursor()
+    
+    try:
+        c.execute("""
+            SELECT id, user_id, text FROM notifications
+            WHERE sent_at IS NULL AND attempts < 5 AND id > ?
+            ORDER BY id LIMIT ?
+        """, (after_id, limit))
+        return c.fetchall()
     finally:
         conn.close()
 
-def delete_all_urls(user_id: int):
-    """Удаление всех ссылок пользователя"""
-    conn = sqlite3.connect('kufar_bot.db')
+def mark_notification(notification_id: int, sent: bool):
+    """Отмечает уведомление отправленным или считает неудачную попытку"""
+    conn = get_connection()
     c = conn.cursor()
     
     try:
-        c.execute("DELETE FROM urls WHERE user_id = ?", (user_id,))
+        if sent:
+            c.execute("UPDATE notifications SET sent_at = CURRENT_TIMESTAMP WHERE id = ?", (notification_id,))
+        else:
+            c.execute("UPDATE notifications SET attempts = attempts + 1 WHERE id = ?", (notification_id,))
         conn.commit()
     finally:
         conn.close()
 
-def send_periodic_updates(context: CallbackContext):
-    """Автоматическая проверка новых объявлений и снижения цен (интервал 6 минут)"""
-    users = get_all_users()
-    for user in users:
-        user_id = user[0]
-        urls = get_user_urls(user_id)
-        filters = get_user_filters(user_id)
-        
-        if not urls:
-            continue
-        
-        min_price = filters[1] if filters else None
-        max_price = filters[2] if filters else None
-        keywords = filters[3] if filters else None
-        
-        new_items_found = False
-        price_drops_found = False
-        messages = []
-        
-        for url_data in urls:
-            url_id = url_data[0]
-            url = url_data[1]
-            last_id = url_data[2] or 0
+def deliver_pending(bot) -> int:
+    """Отправляет всю очередь уведомлений пачками; возвращает число доставленных.
+    Неудачные попытки повторяются при следующем вызове, а не в этом же проходе"""
+    delivered = 0
+    last_id = 0
+    while True:
+        batch = get_pending_notifications(after_id=last_id)
+        if not batch:
+            return delivered
+        for notification_id, user_id, text in batch:
+            sent = send_user_messages(bot, user_id, [text]) == 1
+            mark_notification(notification_id, sent)
+            delivered += sent
+        last_id = batch[-1][0]
+
+def deliver_notifications(context: CallbackContext):
+    """Стадии ленты событий от воркеров и рассылка уведомлений"""
+    run_feed_stages()
+    deliver_pending(context.bot)
+
+def run_worker():
+    """Процесс-воркер: арендует ссылки из БД, парсит их и пишет события в ленту"""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    init_db()
+    load_lsh_index()
+    print(f"🛠️ Воркер {worker_id} запущен")
+    watch_refreshed_at = 0.0
+    
+    try:
+        while True:
+            # Закладки — одной пачкой за интервал проверки на воркер
+            if time.time() - watch_refreshed_at >= CHECK_INTERVAL:
+                watch_refreshed_at = time.time()
+                try:
+                    refresh_watched_ads(worker_id)
+                except Exception as e:
+                    print(f"Ошибка обновления закладок: {e}")
             
+            jobs = claim_due_urls(worker_id, WORKER_BATCH, LEASE_SECONDS)
+            if not jobs:
+                time.sleep(WORKER_IDLE_SLEEP)
+                continue
+            
+            # Свежие множества и подписи из БД: ссылку мог проверять другой воркер
+            url_ids = [job[1] for job in jobs]
+            load_seen_sets(url_ids)
+            load_lsh_index()
             try:
-                items = parse_kufar_url(url, min_price, max_price, keywords)
-                
-                # Проверка новых объявлений
-                new_items = [
-                    item for item in items 
-                    if int(item['id']) > last_id
-                ]
-                
-                # Проверка снижения цены для всех объявлений
-                price_drops = get_price_drops(user_id, items)
-                
-                # Обработка новых объявлений
-                if new_items:
-                    new_items_found = True
-                    
-                    # Сохраняем цены для новых объявлений
-                    for item in new_items:
-                        save_price_data(
-                            user_id, 
-                            item['id'], 
-                            item['title'], 
-                            item['price_int'], 
-                            item['url']
-                        )
-                    
-                    # Формируем сообщение о новых объявлениях
-                    message = "✨ *Новые объявления*:\n\n"
-                    for item in new_items[:3]:  # Максимум 3 объявления за раз
-                        risk_message = get_risk_message(item['risk_data'])
-                        
-                        message += f"💰 *{item['price']}*\n"
-                        message += f"📌 [{item['title']}]({item['url']})\n"
-                        
-                        if risk_message:
-                            message += f"\n{risk_message}\n"
-                        
-                        message += "\n"
-                    
-                    messages.append(message)
-                    
-                    # Обновляем last_id на максимальный из новых
-                    new_last_id = max(int(item['id']) for item in new_items)
-                    update_last_id(user_id, url_id, new_last_id)
-                
-                # Обработка снижения цен
-                if price_drops:
-                    price_drops_found = True
-                    
-                    message = "📉 *Цены упали!*\n\n"
-                    for drop in price_drops[:3]:  # Максимум 3 уведомления
-                        item = drop['item']
-                        risk_message = get_risk_message(item['risk_data'])
-                        
-                        message += f"📉 Снижение на *{drop['drop_percent']}%* ({drop['drop_amount']} BYN)!\n"
-                        message += f"💰 Было: *{drop['old_price']} BYN*\n"
-                        message += f"💰 Стало: *{item['price']}*\n"
-                        message += f"📌 [{item['title']}]({item['url']})\n"
-                        
-                        if risk_message:
-                            message += f"\n{risk_message}\n"
-                        
-                        message += "\n"
+                for user_id, url_id, url, last_id, min_price, max_price, keywords in jobs:
+                    try:
+                        check_url(user_id, url_id, url, last_id or 0, min_price, max_price, keywords)
+                    except Exception as e:
+                        print(f"Ошибка при обработке URL {url} для пользователя {user_id}: {e}")
+            finally:
+                flush_seen_sets()
+                flush_signatures()
+                forget_seen_sets(url_ids)
+                for url_id in url_ids:
+                    complete_url(worker_id, url_id)
+    except KeyboardInterrupt:
+        print(f"⏹️ Воркер {worker_id} остановлен")
+    finally:
+        release_leases(worker_id)
+
+# Повторный импорт того же файла ничего не дублирует
+IMPORT_SQL = {
+    'users': """
+        INSERT INTO users (user_id, chat_id) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET chat_id = excluded.chat_id
+    """,
+    'urls': """
+        INSERT INTO urls (user_id, url, last_id, seen_ids) SELECT ?1, ?2, COALESCE(?3, 0), ?4
+        WHERE NOT EXISTS (SELECT 1 FROM urls WHERE user_id = ?1 AND url = ?2)
+    """,
+    'filters': """
+        INSERT INTO filters (user_id, min_price, max_price, keywords) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET
+            min_price = excluded.min_price, max_price = excluded.max_price, keywords = excluded.keywords
+    """,
+    'price_history': """
+        INSERT INTO price_history (user_id, ad_id, title, price, url, timestamp)
+        SELECT ?1, ?2, ?3, ?4, ?5, COALESCE(?6, CURRENT_TIMESTAMP)
+        WHERE NOT EXISTS (SELECT 1 FROM price_history WHERE user_id = ?1 AND ad_id = ?2 AND timestamp = ?6)
+    """
+}
+
+def open_dump(path: str, mode: str):
+    """Файл выгрузки; .gz сжимается на лету (уровень 6: почти как 9, но в разы быстрее)"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', compresslevel=6, encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+def is_csv_dump(path: str) -> bool:
+    """CSV для *.csv[.gz], иначе JSON Lines"""
+    return path.endswith(('.csv', '.csv.gz'))
+
+def backup_database(path: str):
+    """Согласованная копия живой БД через online backup API SQLite"""
+    source = get_connection()
+    target = sqlite3.connect(path)
+    try:
+        # Копия делается за один шаг: в режиме WAL писатели при этом не блокируются,
+        # а снимок не перезапускается из-за их изменений
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def export_data(path: str, tables: list = None):
+    """Потоковая выгрузка таблиц в JSON Lines или CSV из согласованного снимка БД"""
+    tables = tables or list(DUMP_COLUMNS)
+    snapshot_dir = os.path.dirname(os.path.abspath(path))
+    fd, snapshot_path = tempfile.mkstemp(suffix='.db', dir=snapshot_dir)
+    os.close(fd)
+    
+    try:
+        backup_database(snapshot_path)
+        conn = sqlite3.connect(snapshot_path)
+        try:
+            with open_dump(path, 'w') as f:
+                writer = csv.writer(f) if is_csv_dump(path) else None
+                for table in tables:
+                    columns = DUMP_COLUMNS[table]
+                    # Заголовок таблицы, затем строки вида [таблица, значения...]
+                    if writer:
+                        writer.writerow(['#table', table, *columns])
+                    else:
+                        f.write(json.dumps({'table': table, 'columns': columns}) + '\n')
                     
-                    messages.append(message)
-            
-            except Exception as e:
-                print(f"Ошибка при обработке URL {url} для пользователя {user_id}: {e}")
+                    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+                    blobs = [i for i, column in enumerate(columns) if column in DUMP_BLOB_COLUMNS]
+                    count = 0
+                    while True:
+                        rows = cursor.fetchmany(DUMP_CHUNK)
+                        if not rows:
+                            break
+                        if blobs:
+                            rows = [encode_dump_blobs(row, blobs) for row in rows]
+                        if writer:
+                            writer.writerows([table, *row] for row in rows)
+                        else:
+                            f.writelines(json.dumps([table, *row], ensure_ascii=False) + '\n' for row in rows)
+                        count += len(rows)
+                    print(f"📤 {table}: {count} строк")
+        finally:
+            conn.close()
+    finally:
+        os.remove(snapshot_path)
+
+def encode_dump_blobs(row: tuple, blobs: list) -> list:
+    """Значения строки выгрузки с BLOB-колонками в base64"""
+    row = list(row)
+    for i in blobs:
+        if row[i] is not None:
+            row[i] = base64.b64encode(row[i]).decode('ascii')
+    return row
+
+def read_dump(path: str):
+    """Строки выгрузки по одной: (таблица, колонки файла, значения)"""
+    csv_dump = is_csv_dump(path)
+    columns = {}
+    with open_dump(path, 'r') as f:
+        for record in (csv.reader(f) if csv_dump else map(json.loads, f)):
+            if not csv_dump and isinstance(record, dict):
+                columns[record['table']] = record['columns']
+            elif csv_dump and record[0] == '#table':
+                columns[record[1]] = record[2:]
+            else:
+                table, values = record[0], record[1:]
+                if csv_dump:
+                    # В CSV нет NULL: пустые поля загружаются как NULL
+                    values = [value if value != '' else None for value in values]
+                yield table, columns[table], values
+
+def import_data(path: str) -> dict:
+    """Потоковая загрузка выгрузки порциями по DUMP_CHUNK строк в транзакции"""
+    conn = get_connection()
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-131072")  # 128 МБ под страницы индексов на время импорта
+    c = conn.cursor()
+    counts = defaultdict(int)
+    batch, batch_table, positions, blobs = [], None, None, []
+    
+    def flush():
+        if batch:
+            c.executemany(IMPORT_SQL[batch_table], batch)
+            conn.commit()
+            counts[batch_table] += len(batch)
+            batch.clear()
+    
+    try:
+        for table, columns, values in read_dump(path):
+            if table not in IMPORT_SQL:
+                continue
+            if table != batch_table:
+                flush()
+                batch_table = table
+                # Колонки файла раскладываются в порядок DUMP_COLUMNS, недостающие — NULL
+                index = {column: i for i, column in enumerate(columns)}
+                positions = [index.get(column) for column in DUMP_COLUMNS[table]]
+                blobs = [i for i, column in enumerate(DUMP_COLUMNS[table]) if column in DUMP_BLOB_COLUMNS]
+            row = [values[i] if i is not None else None for i in positions]
+            for i in blobs:
+                if row[i] is not None:
+                    row[i] = base64.b64decode(row[i])
+            batch.append(row)
+            if len(batch) >= DUMP_CHUNK:
+                flush()
+        flush()
+        return dict(counts)
+    finally:
+        conn.close()
+
+def run_data_command(args: list):
+    """CLI выгрузки: export <файл> [таблицы...], import <файл>, backup <файл.db>"""
+    if len(args) < 2 or args[0] not in ('export', 'import', 'backup'):
+        print("Использование: python main.py export <файл.jsonl[.gz]|файл.csv[.gz]> [таблицы...]\n"
+              "               python main.py import <файл>\n"
+              "               python main.py backup <копия.db>")
+        sys.exit(2)
+    
+    command, path = args[0], args[1]
+    tables = args[2:]
+    unknown = [table for table in tables if table not in DUMP_COLUMNS]
+    if unknown:
+        print(f"❌ Неизвестные таблицы: {', '.join(unknown)}; доступны: {', '.join(DUMP_COLUMNS)}")
+        sys.exit(2)
+    
+    init_db()
+    started = time.monotonic()
+    if command == 'backup':
+        backup_database(path)
+    elif command == 'export':
+        export_data(path, tables)
+    else:
+        for table, count in import_data(path).items():
+            print(f"📥 {table}: {count} строк обработано")
+    print(f"✅ {command}: {path} за {time.monotonic() - started:.1f} с")
+
+def run_consumer(stages: list):
+    """Процесс-потребитель ленты: `python main.py consumer notify history`"""
+    unknown = [stage for stage in stages if stage not in FEED_CONSUMERS]
+    if not stages or unknown:
+        print(f"Использование: python main.py consumer <стадии...>; доступны: {', '.join(FEED_CONSUMERS)}")
+        sys.exit(2)
+    
+    init_db()
+    print(f"🛠️ Потребитель ленты запущен: {', '.join(stages)}")
+    try:
+        while True:
+            if not any(run_feed_stages(stages).values()):
+                time.sleep(WORKER_IDLE_SLEEP)
+    except KeyboardInterrupt:
+        print("⏹️ Потребитель ленты остановлен")
+
+def percentile(sorted_values: list, q: float):
+    """Процентиль q (0..1) отсортированного списка"""
+    if not sorted_values:
+        return None
+    index = min(int(round(q * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+class HandlerMetrics:
+    """Счетчики и задержки обработчиков апдейтов"""
+
+    def __init__(self, window: int = 500):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.shed = defaultdict(int)
+
+    def record(self, name: str, seconds: float, ok: bool):
+        """Учитывает выполнение обработчика"""
+        with self.lock:
+            self.latencies[name].append(seconds)
+            self.counts[name] += 1
+            if not ok:
+                self.errors[name] += 1
+
+    def record_shed(self, name: str):
+        """Учитывает апдейт, отклоненный из-за перегрузки"""
+        with self.lock:
+            self.shed[name] += 1
+
+    def stats(self) -> dict:
+        """Сводка по обработчикам: число вызовов, ошибки, p50/p95/max задержки"""
+        with self.lock:
+            result = {}
+            for name in set(self.counts) | set(self.shed):
+                values = sorted(self.latencies[name])
+                result[name] = {
+                    'count': self.counts[name],
+                    'errors': self.errors[name],
+                    'shed': self.shed[name],
+                    'p50': round(percentile(values, 0.5), 3) if values else None,
+                    'p95': round(percentile(values, 0.95), 3) if values else None,
+                    'max': round(values[-1], 3) if values else None
+                }
+            return result
+
+HANDLER_METRICS = HandlerMetrics()
+
+def run_timed(name: str, callback, update: Update, context: CallbackContext, started: float = None):
+    """Выполняет обработчик и записывает его задержку"""
+    started = started or time.monotonic()
+    ok = False
+    try:
+        result = callback(update, context)
+        ok = True
+        return result
+    finally:
+        HANDLER_METRICS.record(name, time.monotonic() - started, ok)
+
+class HandlerPool:
+    """Ограниченный пул для медленных обработчиков с отказом при переполнении очереди"""
+
+    def __init__(self, workers: int = HANDLER_WORKERS, queue_limit: int = HANDLER_QUEUE_LIMIT,
+                 thread_name_prefix: str = 'handler'):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix)
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, name: str, callback, update: Update, context: CallbackContext) -> bool:
+        """Ставит обработчик в очередь; False, если очередь переполнена"""
+        with self.lock:
+            if self.pending >= self.queue_limit:
+                return False
+            self.pending += 1
         
-        # Отправляем сообщения пользователю
-        if (new_items_found or price_drops_found) and messages:
-            for msg in messages:
-                try:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=msg,
-                        parse_mode='Markdown',
-                        disable_web_page_preview=True
-                    )
-                    time.sleep(1)  # Задержка между сообщениями
-                except Exception as e:
-                    print(f"Ошибка отправки сообщения пользователю {user_id}: {e}")
+        # Задержка считается с момента постановки в очередь — так ее видит пользователь
+        self.executor.submit(self._run, name, callback, update, context, time.monotonic())
+        return True
+
+    def _run(self, name: str, callback, update: Update, context: CallbackContext, queued_at: float):
+        try:
+            run_timed(name, callback, update, context, started=queued_at)
+        except Exception as e:
+            print(f"Ошибка в обработчике {name}: {e}")
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def stats(self) -> dict:
+        """Глубина очереди пула"""
+        with self.lock:
+            return {'pending': self.pending, 'limit': self.queue_limit}
+
+HANDLER_POOL = HandlerPool()
+CRAWL_HANDLER_POOL = HandlerPool(CRAWL_HANDLER_WORKERS, CRAWL_HANDLER_QUEUE_LIMIT, 'crawl-handler')
+
+def reply_busy(update: Update):
+    """Вежливый отказ при перегрузке"""
+    try:
+        if update.callback_query:
+            update.callback_query.answer(BUSY_TEXT)
+        elif update.effective_message:
+            update.effective_message.reply_text(BUSY_TEXT)
+    except Exception as e:
+        print(f"Не удалось отправить ответ о перегрузке: {e}")
+
+def timed(name: str, callback):
+    """Быстрый обработчик: выполняется в диспетчере, задержка учитывается"""
+    def handler(update: Update, context: CallbackContext):
+        return run_timed(name, callback, update, context)
+    return handler
+
+def pooled(name: str, callback, returns=None, pool: HandlerPool = None):
+    """Медленный обработчик (БД, сеть): уходит в пул, диспетчер сразу свободен"""
+    def handler(update: Update, context: CallbackContext):
+        if not (pool or HANDLER_POOL).submit(name, callback, update, context):
+            HANDLER_METRICS.record_shed(name)
+            reply_busy(update)
+        return returns
+    return handler
+
+def save_crawl_state(context: CallbackContext = None):
+    """Сохраняет снимок состояния парсера (атомарно, через временный файл)"""
+    # Виденные объявления и подписи живут в БД, снимок лишь дописывает их
+    flush_seen_sets()
+    flush_signatures()
+    
+    # Цикл проверки продолжает писать в словари — сериализуем копии
+    with crawl_state_lock:
+        polled = dict(url_last_polled)
+        fingerprints = dict(url_fingerprints)
+    
+    state = {
+        'version': 2,
+        'saved_at': time.time(),
+        'last_cycle_started': last_cycle_started,
+        'carry_over': list(carry_over_ids),
+        'url_last_polled': polled,
+        'fingerprints': fingerprints,
+        'parse_cache': PARSE_CACHE.export()
+    }
+    
+    tmp_path = f"{SNAPSHOT_PATH}.tmp"
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, SNAPSHOT_PATH)
+    except Exception as e:
+        print(f"Ошибка сохранения снимка состояния: {e}")
+
+def restore_crawl_state() -> bool:
+    """Восстанавливает снимок при запуске; True, если состояние подхвачено"""
+    global carry_over_ids, last_cycle_started
+    try:
+        with gzip.open(SNAPSHOT_PATH, 'rt', encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        print(f"⚠️ Снимок состояния поврежден, начинаем с нуля: {e}")
+        return False
+    
+    if state.get('version') != 2 or time.time() - state.get('saved_at', 0) > SNAPSHOT_MAX_AGE:
+        print("⚠️ Снимок состояния устарел, начинаем с нуля")
+        return False
+    
+    # JSON хранит ключи строками
+    last_cycle_started = state['last_cycle_started']
+    carry_over_ids = state['carry_over']
+    url_last_polled.update({int(k): v for k, v in state['url_last_polled'].items()})
+    url_fingerprints.update({int(k): v for k, v in state['fingerprints'].items()})
+    PARSE_CACHE.load(state['parse_cache'])
+    
+    print(f"♻️ Состояние восстановлено: {len(url_last_polled)} ссылок, "
+          f"{len(state['parse_cache'])} результатов в кэше")
+    return True
 
 def start(update: Update, context: CallbackContext) -> None:
     """Стартовое меню"""
@@ -749,19 +3133,37 @@ def manual_parse(update: Update, context: CallbackContext) -> int:
     max_price = filters[2] if filters else None
     keywords = filters[3] if filters else None
     
-    update.message.reply_text(
-        "⏳ Начинаю парсинг...\n"
-        "Это может занять до 1 минуты. Пожалуйста, подождите!",
-        reply_markup=ReplyKeyboardRemove()
-    )
+    # Один ручной запуск на пользователя: повторное нажатие не плодит загрузки
+    with manual_runs_lock:
+        if user_id in manual_runs:
+            update.message.reply_text("⏳ Парсинг уже идет, дождитесь результатов!")
+            return ConversationHandler.END
+        manual_runs.add(user_id)
     
+    # Обработчик уже выполняется в пуле долгих задач (CRAWL_HANDLER_POOL): загрузка идет здесь же,
+    # в пределах CRAWL_HANDLER_QUEUE_LIMIT и с учетом в метриках задержки
+    try:
+        progress = update.message.reply_text(
+            f"⏳ Начинаю парсинг: 0/{len(urls)} ссылок...\n"
+            "Это может занять до 1 минуты. Пожалуйста, подождите!",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        send_manual_results(update, progress, user_id, urls, min_price, max_price, keywords)
+    finally:
+        with manual_runs_lock:
+            manual_runs.discard(user_id)
+    return ConversationHandler.END
+
+def send_manual_results(update: Update, progress, user_id: int, urls: list,
+                        min_price: int, max_price: int, keywords: str):
+    """Собирает результаты ручного парсинга и отправляет их пользователю"""
     all_items = []
     price_drops = []
     
-    for url_data in urls:
+    for done, url_data in enumerate(urls, 1):
         url = url_data[1]
         try:
-            items = parse_kufar_url(url, min_price, max_price, keywords)
+            items = get_listings(url, min_price, max_price, keywords)
             all_items.extend(items[:3])  # Берем максимум 3 объявления с каждой ссылки
             
             # Проверяем снижение цен для текущего парсинга
@@ -769,6 +3171,17 @@ def manual_parse(update: Update, context: CallbackContext) -> int:
             price_drops.extend(drops)
         except Exception as e:
             print(f"Ошибка при ручном парсинге {url}: {e}")
+        
+        if done < len(urls):
+            try:
+                progress.edit_text(f"⏳ Парсинг: {done}/{len(urls)} ссылок...")
+            except Exception as e:
+                print(f"Не удалось обновить прогресс для пользователя {user_id}: {e}")
+    
+    try:
+        progress.edit_text(f"✅ Проверено ссылок: {len(urls)}")
+    except Exception:
+        pass
     
     # Формируем сообщение
     message_parts = []
@@ -777,12 +3190,12 @@ def manual_parse(update: Update, context: CallbackContext) -> int:
         drop_msg = "📉 *Обнаружено снижение цен:*\n\n"
         for drop in price_drops[:3]:
             item = drop['item']
-            risk_message = get_risk_message(item['risk_data'])
+            risk_message = get_risk_message(item.risk_data)
             
             drop_msg += f"📉 Снижение на *{drop['drop_percent']}%*!\n"
             drop_msg += f"💰 Было: *{drop['old_price']} BYN*\n"
-            drop_msg += f"💰 Стало: *{item['price']}*\n"
-            drop_msg += f"📌 [{item['title']}]({item['url']})\n"
+            drop_msg += f"💰 Стало: *{item.price}*\n"
+            drop_msg += f"📌 [{item.title}]({item.url})\n"
             
             if risk_message:
                 drop_msg += f"\n{risk_message}\n"
@@ -793,10 +3206,10 @@ def manual_parse(update: Update, context: CallbackContext) -> int:
     if all_items:
         items_msg = "✨ *Результаты парсинга:*\n\n"
         for i, item in enumerate(all_items[:5], 1):  # Максимум 5 объявлений
-            risk_message = get_risk_message(item['risk_data'])
+            risk_message = get_risk_message(item.risk_data)
             
-            items_msg += f"{i}. 💰 {item['price']}\n"
-            items_msg += f"📌 [{item['title']}]({item['url']})\n"
+            items_msg += f"{i}. 💰 {item.price}\n"
+            items_msg += f"📌 [{item.title}]({item.url})\n"
             
             if risk_message:
                 items_msg += f"\n{risk_message}\n"
@@ -810,7 +3223,7 @@ def manual_parse(update: Update, context: CallbackContext) -> int:
             "Попробуйте изменить фильтры или добавить другие ссылки",
             reply_markup=ReplyKeyboardMarkup([["🏠 Вернуться в меню"]], resize_keyboard=True)
         )
-        return ConversationHandler.END
+        return
     
     # Отправляем все части сообщения
     for part in message_parts:
@@ -825,8 +3238,6 @@ def manual_parse(update: Update, context: CallbackContext) -> int:
         "Я буду продолжать отслеживать эти ссылки автоматически каждые 6 минут.",
         reply_markup=ReplyKeyboardMarkup([["🏠 Вернуться в меню"]], resize_keyboard=True)
     )
-    
-    return ConversationHandler.END
 
 def show_urls(update: Update, context: CallbackContext) -> None:
     """Показывает список добавленных ссылок"""
@@ -857,12 +3268,130 @@ def show_urls(update: Update, context: CallbackContext) -> None:
         reply_markup=reply_markup
     )
 
+def show_stats(update: Update, context: CallbackContext) -> None:
+    """Статистика цен: по отслеживаемым ссылкам или по объявлению (/stats <ссылка или ID>)"""
+    user_id = update.effective_user.id
+    menu = ReplyKeyboardMarkup([["🏠 Вернуться в меню"]], resize_keyboard=True)
+    
+    if context.args:
+        match = re.search(r'(?:item/)?(\d+)', context.args[0])
+        if not match:
+            update.message.reply_text("❌ Укажите ссылку на объявление или его номер: /stats 123456789")
+            return
+        
+        ad_id = match.group(1)
+        points = get_ad_price_series(ad_id)
+        if not points:
+            update.message.reply_text("🔍 По этому объявлению пока нет истории цен", reply_markup=menu)
+            return
+        
+        prices = [price for _, price in points]
+        first_price, current_price = prices[0], prices[-1]
+        message = f"📈 *История цены объявления {ad_id}*\n\n"
+        message += f"💰 Первая цена: *{first_price} BYN* ({time.strftime('%d.%m.%Y', time.gmtime(points[0][0]))})\n"
+        message += f"💰 Сейчас: *{current_price} BYN*\n"
+        message += f"📊 Мин / макс: {min(prices)} / {max(prices)} BYN\n"
+        message += f"🔁 Изменений цены: {len(points) - 1}\n"
+        if first_price and current_price != first_price:
+            change = round((current_price - first_price) / first_price * 100, 1)
+            message += f"{'📉' if change < 0 else '📈'} С момента появления: {change:+}%\n"
+        
+        update.message.reply_text(message, parse_mode='Markdown', reply_markup=menu)
+        return
+    
+    urls = get_user_urls(user_id)
+    if not urls:
+        update.message.reply_text(
+            "📭 У вас нет добавленных ссылок\n"
+            "Нажмите `🔗 Добавить ссылку`, чтобы начать отслеживание",
+            reply_markup=menu
+        )
+        return
+    
+    message = "📈 *Статистика цен за 30 дней*\n\n"
+    for i, url_data in enumerate(urls, 1):
+        stats = get_search_price_stats(url_data[0])
+        message += f"{i}. {url_data[1]}\n"
+        if not stats:
+            message += "   Данных пока нет — статистика появится после первых проверок\n\n"
+            continue
+        
+        message += f"   Медиана: *{stats['median']} BYN* (половина цен: {stats['p25']}–{stats['p75']} BYN)\n"
+        message += f"   Мин / макс: {stats['min']} / {stats['max']} BYN, объявлений: {stats['ads']}\n"
+        if stats['trend'] is not None:
+            message += f"   {'📉' if stats['trend'] < 0 else '📈'} За неделю: {stats['trend']:+}%\n"
+        message += "\n"
+    
+    message += "💡 История цены объявления: /stats <ссылка на объявление>"
+    update.message.reply_text(
+        message,
+        parse_mode='Markdown',
+        disable_web_page_preview=True,
+        reply_markup=menu
+    )
+
+def watch_command(update: Update, context: CallbackContext) -> None:
+    """/watch <ссылка или ID> — добавить объявление в закладки"""
+    match = re.search(r'(?:item/)?(\d+)', context.args[0]) if context.args else None
+    if not match:
+        update.message.reply_text("❌ Укажите ссылку на объявление или его номер: /watch 123456789")
+        return
+    
+    update.message.reply_text(WATCH_REPLIES[watch_ad(update.effective_user.id, match.group(1))])
+
+def unwatch_command(update: Update, context: CallbackContext) -> None:
+    """/unwatch <ссылка или ID> — убрать объявление из закладок"""
+    match = re.search(r'(?:item/)?(\d+)', context.args[0]) if context.args else None
+    if not match:
+        update.message.reply_text("❌ Укажите ссылку на объявление или его номер: /unwatch 123456789")
+        return
+    
+    removed = unwatch_ad(update.effective_user.id, match.group(1))
+    update.message.reply_text("✅ Объявление убрано из закладок" if removed else "🔍 Этого объявления нет в закладках")
+
+def show_watchlist(update: Update, context: CallbackContext) -> None:
+    """Показывает закладки пользователя"""
+    ads = get_user_watchlist(update.effective_user.id)
+    if not ads:
+        update.message.reply_text(
+            "📭 Закладок пока нет\n"
+            "Нажмите «👁 Следить» под уведомлением или отправьте /watch <ссылка на объявление>"
+        )
+        return
+    
+    message = f"{WATCH_TEXT} ({len(ads)}/{WATCH_LIMIT}):\n\n"
+    for i, (ad_id, title, price, active) in enumerate(ads, 1):
+        status = f"{price} BYN" if price else "цена уточняется"
+        if not active:
+            status = "снято с продажи"
+        message += f"{i}. [{title or ad_id}]({ITEM_URL_PREFIX}{ad_id}) — {status}\n"
+    
+    update.message.reply_text(
+        message,
+        parse_mode='Markdown',
+        disable_web_page_preview=True,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"✖️ Не следить: {(title or ad_id)[:30]}", callback_data=f"unwatch:{ad_id}")]
+            for ad_id, title, _, _ in ads
+        ])
+    )
+
 def button_handler(update: Update, context: CallbackContext) -> None:
     """Обработчик инлайн-кнопок"""
     query = update.callback_query
-    query.answer()
     user_id = query.from_user.id
     
+    # Кнопки закладок отвечают всплывающим уведомлением и не меняют сообщение
+    action, _, ad_id = query.data.partition(':')
+    if action == 'watch':
+        query.answer(WATCH_REPLIES[watch_ad(user_id, ad_id)])
+        return
+    if action == 'unwatch':
+        removed = unwatch_ad(user_id, ad_id)
+        query.answer("✅ Убрано из закладок" if removed else "Этого объявления уже нет в закладках")
+        return
+    
+    query.answer()
     if query.data == 'delete_urls':
         delete_all_urls(user_id)
         query.edit_message_text(
@@ -882,7 +3411,14 @@ def show_help(update: Update, context: CallbackContext) -> None:
         "🔍 *Умное отслеживание цен:*\n"
         "- Бот автоматически отслеживает цены на объявления\n"
         "- При снижении цены вы получите алерт с указанием процентов\n"
-        "- Пример: \"📉 Снижение на 15% (200 BYN)!\"\n\n"
+        "- Пример: \"📉 Снижение на 15% (200 BYN)!\"\n"
+        "- /stats — медиана и тренд цен по вашим ссылкам\n"
+        "- /stats <ссылка на объявление> — история его цены\n\n"
+        
+        "👁 *Закладки:*\n"
+        "- Кнопка «👁 Следить» под уведомлением или /watch <ссылка на объявление>\n"
+        "- Бот сообщит о снижении цены, даже когда объявление ушло с первой страницы поиска\n"
+        "- /watchlist — ваши закладки, /unwatch <ссылка> — убрать\n\n"
         
         "🛡️ *AI-анализ мошенничества:*\n"
         "- Бот анализирует текст объявлений на рисковые фразы\n"
@@ -924,67 +3460,100 @@ def cancel(update: Update, context: CallbackContext) -> int:
 
 def main():
     """Основная функция запуска бота"""
+    # В режиме polling health-эндпоинт поднимается первым, до тяжелых импортов
+    # (в режиме вебхука порт сначала занимает сам вебхук, как и раньше)
+    if not APP_NAME:
+        threading.Thread(target=run_flask, daemon=True).start()
+        print(f"✅ Flask сервер запущен на порту {PORT}")
+    
     init_db()
+    restored = restore_crawl_state()
+    load_telegram()
     
-    updater = Updater(TOKEN, use_context=True)
+    updater = Updater(TOKEN, use_context=True, workers=DISPATCHER_WORKERS)
     dp = updater.dispatcher
     
+    # Обработчики, которые ходят в БД или сеть, выполняются в пуле (pooled),
+    # меню и подсказки отвечают сразу из диспетчера (timed)
+    
     # Обработчики команд
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", show_help))
+    dp.add_handler(CommandHandler("start", pooled('start', start)))
+    dp.add_handler(CommandHandler("help", timed('help', show_help)))
+    dp.add_handler(CommandHandler("stats", pooled('stats', show_stats)))
+    dp.add_handler(CommandHandler("watch", pooled('watch', watch_command)))
+    dp.add_handler(CommandHandler("unwatch", pooled('unwatch', unwatch_command)))
+    dp.add_handler(CommandHandler("watchlist", pooled('watchlist', show_watchlist)))
     
     # Обработчик инлайн-кнопок
-    dp.add_handler(CallbackQueryHandler(button_handler))
+    dp.add_handler(CallbackQueryHandler(pooled('button', button_handler)))
     
     # Диалог добавления ссылки
     conv_handler_url = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex('^🔗 Добавить ссылку$'), add_url)],
+        entry_points=[MessageHandler(Filters.regex('^🔗 Добавить ссылку$'), timed('add_url', add_url))],
         states={
-            ADD_URL: [MessageHandler(Filters.text & ~Filters.command, save_url)]
+            ADD_URL: [MessageHandler(Filters.text & ~Filters.command, timed('save_url', save_url))]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', timed('cancel', cancel))]
     )
     
     # Диалог настройки фильтров
     conv_handler_filters = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex('^⚙️ Настроить фильтры$'), set_filters)],
+        entry_points=[MessageHandler(Filters.regex('^⚙️ Настроить фильтры$'), timed('set_filters', set_filters))],
         states={
             SET_MIN_PRICE: [
-                MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), cancel),
-                MessageHandler(Filters.text & ~Filters.command, set_min_price)
+                MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), timed('cancel', cancel)),
+                MessageHandler(Filters.text & ~Filters.command, timed('set_min_price', set_min_price))
             ],
             SET_MAX_PRICE: [
-                MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), cancel),
-                MessageHandler(Filters.text & ~Filters.command, set_max_price)
+                MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), timed('cancel', cancel)),
+                MessageHandler(Filters.text & ~Filters.command, timed('set_max_price', set_max_price))
             ],
             SET_KEYWORDS: [
-                MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), cancel),
-                MessageHandler(Filters.text & ~Filters.command, save_filters)
+                MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), timed('cancel', cancel)),
+                # Все ветки save_filters завершают диалог
+                MessageHandler(Filters.text & ~Filters.command,
+                               pooled('save_filters', save_filters, returns=ConversationHandler.END))
             ]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', timed('cancel', cancel))]
     )
     
     # Диалог ручного парсинга
     conv_handler_parse = ConversationHandler(
-        entry_points=[MessageHandler(Filters.regex('^▶️ Запустить вручную$'), manual_parse)],
+        entry_points=[MessageHandler(Filters.regex('^▶️ Запустить вручную$'),
+                                     pooled('manual_parse', manual_parse, returns=ConversationHandler.END,
+                                            pool=CRAWL_HANDLER_POOL))],
         states={},
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', timed('cancel', cancel))]
     )
     
     # Регистрация обработчиков
     dp.add_handler(conv_handler_url)
     dp.add_handler(conv_handler_filters)
     dp.add_handler(conv_handler_parse)
-    dp.add_handler(MessageHandler(Filters.regex('^📊 Мои ссылки$'), show_urls))
+    dp.add_handler(MessageHandler(Filters.regex('^📊 Мои ссылки$'), pooled('show_urls', show_urls)))
     dp.add_handler(MessageHandler(Filters.regex('^🛑 Остановить уведомления$'), 
-                  lambda u, c: u.message.reply_text("⏹️ Уведомления временно отключены. Чтобы включить — перезапустите бота")))
-    dp.add_handler(MessageHandler(Filters.regex('^ℹ️ Помощь$'), show_help))
-    dp.add_handler(MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), start))
+                  timed('stop', lambda u, c: u.message.reply_text("⏹️ Уведомления временно отключены. Чтобы включить — перезапустите бота"))))
+    dp.add_handler(MessageHandler(Filters.regex('^ℹ️ Помощь$'), timed('help', show_help)))
+    dp.add_handler(MessageHandler(Filters.regex('^🏠 Вернуться в меню$'), pooled('start', start)))
     
     # 🔥 ГЛАВНОЕ ИЗМЕНЕНИЕ: интервал 6 минут (360 секунд)
     job_queue = updater.job_queue
-    job_queue.run_repeating(send_periodic_updates, interval=360, first=10)  # Каждые 6 минут!
+    if CRAWL_MODE == 'workers':
+        # Парсят отдельные процессы, бот прогоняет стадии ленты (FEED_STAGES) и доставляет уведомления
+        job_queue.run_repeating(deliver_notifications, interval=DELIVERY_INTERVAL, first=5)
+    else:
+        load_seen_sets()
+        load_lsh_index()
+        # После перезапуска продолжаем прежний ритм, а не начинаем полный обход сразу
+        first = 10
+        if restored and last_cycle_started:
+            first = max(10, last_cycle_started + CHECK_INTERVAL - time.time())
+        job_queue.run_repeating(send_periodic_updates, interval=CHECK_INTERVAL, first=first)  # Каждые 6 минут!
+        job_queue.run_repeating(save_crawl_state, interval=SNAPSHOT_INTERVAL, first=SNAPSHOT_INTERVAL)
+    
+    # Обслуживание агрегатов цен и индекса повторов — раз в сутки, вне обработки апдейтов
+    job_queue.run_repeating(daily_maintenance, interval=86400, first=60)
     
     # Настройка вебхуков для Replit
     if APP_NAME:
@@ -1000,11 +3569,20 @@ def main():
         print("✅ Бот запущен в режиме polling")
     
     # Запуск Flask для health-check
-    threading.Thread(target=run_flask, daemon=True).start()
-    print(f"✅ Flask сервер запущен на порту {PORT}")
+    if APP_NAME:
+        threading.Thread(target=run_flask, daemon=True).start()
+        print(f"✅ Flask сервер запущен на порту {PORT}")
     
     print("✨ Kufar Bot PRO готов к работе! Проверка каждые 6 минут!")
     updater.idle()
+    save_crawl_state()
 
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        run_worker()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'consumer':
+        run_consumer(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] in ('export', 'import', 'backup'):
+        run_data_command(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая база в каталоге теста"""
+    monkeypatch.setattr(main, 'DB_PATH', str(tmp_path / 'kufar_bot.db'))
+    main.init_db()
+    return main
@@ -0,0 +1,16 @@
+"""Снимок состояния парсера"""
+import main
+
+
+def test_snapshot_round_trip(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'SNAPSHOT_PATH', str(tmp_path / 'crawl_state.json.gz'))
+    monkeypatch.setattr(main, 'url_last_polled', {7: 1000.0})
+    monkeypatch.setattr(main, 'url_fingerprints', {7: 'abc'})
+    main.save_crawl_state()
+
+    monkeypatch.setattr(main, 'url_last_polled', {})
+    monkeypatch.setattr(main, 'url_fingerprints', {})
+
+    assert main.restore_crawl_state()
+    assert main.url_last_polled == {7: 1000.0}
+    assert main.url_fingerprints == {7: 'abc'}
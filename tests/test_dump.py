@@ -0,0 +1,31 @@
+"""Выгрузка и загрузка данных"""
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('name', ['dump.jsonl.gz', 'dump.csv'])
+def test_seen_ids_survive_export_and_import(db, tmp_path, monkeypatch, name):
+    seen = main.SeenSet()
+    for ad_id in (1001, 1002, 'abc'):
+        seen.add(ad_id)
+    conn = db.get_connection()
+    conn.execute("INSERT INTO users (user_id, chat_id) VALUES (1, 1)")
+    conn.execute("INSERT INTO urls (user_id, url, seen_ids) VALUES (1, 'https://www.kufar.by/l/a', ?)",
+                 (seen.to_blob(),))
+    conn.execute("INSERT INTO urls (user_id, url) VALUES (1, 'https://www.kufar.by/l/b')")
+    conn.commit()
+    conn.close()
+
+    path = str(tmp_path / name)
+    main.export_data(path)
+    monkeypatch.setattr(main, 'DB_PATH', str(tmp_path / 'imported.db'))
+    main.init_db()
+    assert main.import_data(path)['urls'] == 2
+
+    conn = main.get_connection()
+    rows = dict(conn.execute("SELECT url, seen_ids FROM urls").fetchall())
+    conn.close()
+    restored = main.SeenSet.from_blob(rows['https://www.kufar.by/l/a'])
+    assert list(restored.ring) == list(seen.ring)
+    assert rows['https://www.kufar.by/l/b'] is None
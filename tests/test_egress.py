@@ -0,0 +1,160 @@
+"""Пул исходящих маршрутов: локальный прокси вместо реальных маршрутов"""
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import main
+
+
+class Origin(BaseHTTPRequestHandler):
+    """Сайт-заглушка: ответ задается атрибутами сервера; proxied_status — ответ запросам через прокси"""
+
+    def do_GET(self):
+        body = self.server.body.encode()
+        proxied = self.headers.get('Via') and self.server.proxied_status
+        self.send_response(self.server.proxied_status if proxied else self.server.status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalProxy(BaseHTTPRequestHandler):
+    """Простейший HTTP-прокси: пересылает GET по абсолютному URL и считает запросы"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        try:
+            request = urllib.request.Request(self.path, headers={'Via': '1.1 local-proxy'})
+            upstream = urllib.request.urlopen(request, timeout=5)
+            status, body = upstream.status, upstream.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler, **attrs):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def origin():
+    server = serve(Origin, status=200, proxied_status=None, body='<html>ok</html>')
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    # Переменные окружения перекрыли бы прокси сессии
+    for name in ('HTTP_PROXY', 'http_proxy', 'HTTPS_PROXY', 'https_proxy', 'NO_PROXY', 'no_proxy',
+                 'ALL_PROXY', 'all_proxy'):
+        monkeypatch.delenv(name, raising=False)
+    server = serve(LocalProxy, requests=[])
+    yield server
+    server.shutdown()
+
+
+def url_of(server, path='/'):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_fetch_goes_through_proxy_route(origin, proxy, monkeypatch):
+    pool = main.EgressPool([main.Egress('proxy:local', proxy=url_of(proxy), rate_per_minute=0)])
+    monkeypatch.setattr(main, 'EGRESS_POOL', pool)
+
+    response = main.fetch_url(url_of(origin, '/l/a'), {})
+
+    assert response.text == '<html>ok</html>'
+    assert proxy.requests == [url_of(origin, '/l/a')]
+    assert pool.stats()[0]['successes'] == 1
+
+
+def test_rate_limited_route_is_banned_and_other_route_used(origin, proxy, monkeypatch):
+    limited = main.Egress('proxy:limited', proxy=url_of(proxy), rate_per_minute=0)
+    spare = main.Egress('direct', rate_per_minute=0)
+    pool = main.EgressPool([limited, spare])
+    monkeypatch.setattr(main, 'EGRESS_POOL', pool)
+    # Сайт ограничил только адрес прокси
+    origin.proxied_status = 429
+
+    # Прямой маршрут пока ждет своего интервала — первый запрос идет через прокси
+    spare.next_allowed = time.monotonic() + 60
+    response = main.fetch_url(url_of(origin, '/l/a'), {})
+
+    assert response.status_code == 429
+    assert proxy.requests == [url_of(origin, '/l/a')]
+    assert limited.banned_until - time.monotonic() > main.EGRESS_BAN_SECONDS - 5
+
+    spare.next_allowed = 0.0
+    response = main.fetch_url(url_of(origin, '/l/a'), {})
+
+    assert response.text == '<html>ok</html>'
+    assert len(proxy.requests) == 1
+    assert [(e['name'], e['bans'], e['successes']) for e in pool.stats()] == [
+        ('proxy:limited', 1, 0), ('direct', 0, 1)]
+
+
+def test_last_route_gets_short_cooldown_instead_of_ban(monkeypatch):
+    monkeypatch.setattr(main, 'EGRESS_LAST_ROUTE_COOLDOWN', 1)
+    only = main.Egress('direct', rate_per_minute=0)
+    pool = main.EgressPool([only])
+
+    pool.report(only, ok=False, latency=0.1, banned=True)
+
+    assert only.banned_until - time.monotonic() <= 1
+    assert pool.acquire(timeout=3) is only
+
+
+def test_cloudflare_analytics_page_is_not_blocked(origin):
+    origin.body = '<html><script src="https://static.cloudflareinsights.com/beacon.min.js"></script></html>'
+    assert not main.is_blocked_response(requests.get(url_of(origin)))
+
+    origin.body = '<html><head><title>Just a moment...</title></head><script>window._cf_chl_opt={}</script></html>'
+    assert main.is_blocked_response(requests.get(url_of(origin)))
+
+    origin.status, origin.body = 429, 'slow down'
+    assert main.is_blocked_response(requests.get(url_of(origin)))
+
+
+def test_route_respects_its_rate_limit():
+    route = main.Egress('direct', rate_per_minute=60)
+    pool = main.EgressPool([route])
+
+    assert pool.acquire(timeout=0) is route
+    # Следующий запрос не раньше чем через 0.5–1.5 с
+    assert pool.acquire(timeout=0) is None
+
+
+def test_weighted_selection_prefers_healthy_route():
+    healthy = main.Egress('healthy', rate_per_minute=0)
+    failing = main.Egress('failing', rate_per_minute=0)
+    pool = main.EgressPool([healthy, failing])
+    for _ in range(20):
+        for egress, ok in ((healthy, True), (failing, False)):
+            egress.in_flight += 1
+            pool.report(egress, ok=ok, latency=0.2)
+
+    picks = []
+    for _ in range(200):
+        egress = pool.acquire(timeout=0)
+        picks.append(egress)
+        pool.report(egress, ok=egress is healthy, latency=0.2)
+
+    assert picks.count(healthy) > 180
@@ -0,0 +1,24 @@
+"""Резервный разбор карточек без __NEXT_DATA__"""
+import main
+
+PAGE = """<html><body>
+<div class="list-item"><a class="title" href="/item/101">Диван</a><div class="price">250 р.</div></div>
+<div class="list-item"><a class="title" href="/item/102">Кресло</a><div class="price">Договорная</div></div>
+<div class="list-item"><a class="title" href="/item/103">Стол</a></div>
+</body></html>"""
+
+
+class FakeResponse:
+    text = PAGE
+    headers = {}
+
+
+def test_missing_price_is_counted_apart_from_negotiable(monkeypatch):
+    monkeypatch.setattr(main, 'fetch_page', lambda url, validators=None: FakeResponse())
+    monkeypatch.setattr(main, 'layout_stats', main.defaultdict(int))
+
+    listings, _ = main.fetch_listings('https://www.kufar.by/l/mebel')
+
+    assert [(item.id, item.price_int) for item in listings] == [('101', 250), ('102', 0), ('103', 0)]
+    assert main.layout_stats['missing_price'] == 1
+    assert main.layout_stats['cards'] == 3
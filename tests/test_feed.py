@@ -0,0 +1,130 @@
+"""Лента событий и отметки ее стадий"""
+import pytest
+
+import main
+
+
+def new_events(count, url_id=1):
+    return [('new', url_id, main.Listing(str(1000 + i), f'Объявление {i}', 100 + i), None)
+            for i in range(count)]
+
+
+def checkpoint(db, stage):
+    conn = db.get_connection()
+    try:
+        row = conn.execute("SELECT seq FROM feed_checkpoints WHERE stage = ?", (stage,)).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def test_stage_reads_batches_from_its_checkpoint(db):
+    db.append_events(new_events(5))
+    seen = []
+
+    def handler(c, events):
+        seen.append([item.id for _, _, _, _, item in events])
+        return len(events)
+
+    assert db.consume_feed('test', handler, limit=3) == (3, 3)
+    assert db.consume_feed('test', handler, limit=3) == (2, 2)
+    assert db.consume_feed('test', handler, limit=3) == (0, 0)
+    assert seen == [['1000', '1001', '1002'], ['1003', '1004']]
+    assert checkpoint(db, 'test') == 5
+
+
+def test_failed_batch_keeps_checkpoint_and_rolls_back_outputs(db):
+    db.append_events(new_events(2))
+
+    def failing(c, events):
+        c.execute("INSERT INTO notifications (user_id, text) VALUES (1, 'half done')")
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        db.consume_feed('notify', failing)
+
+    conn = db.get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0] == 0
+    conn.close()
+    assert checkpoint(db, 'notify') is None
+    # Повторный запуск получает ту же пачку
+    assert db.consume_feed('notify', lambda c, events: len(events)) == (2, 2)
+
+
+def test_stages_progress_independently(db):
+    db.append_events(new_events(4))
+
+    db.consume_feed('fast', lambda c, events: 0)
+    db.consume_feed('slow', lambda c, events: 0, limit=1)
+
+    assert checkpoint(db, 'fast') == 4
+    assert checkpoint(db, 'slow') == 1
+    assert db.consume_feed('slow', lambda c, events: 0)[0] == 3
+
+
+def test_prune_keeps_events_for_stage_without_checkpoint(db, monkeypatch):
+    monkeypatch.setattr(db, 'FEED_RETENTION_DAYS', 0)
+    db.append_events(new_events(3))
+    for stage in db.FEED_CONSUMERS:
+        if stage != 'risk':
+            db.consume_feed(stage, lambda c, events: 0)
+
+    db.prune_feed()
+    conn = db.get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM ad_events").fetchone()[0] == 3
+    conn.close()
+
+    db.consume_feed('risk', lambda c, events: 0)
+    db.prune_feed()
+    conn = db.get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM ad_events").fetchone()[0] == 0
+    conn.close()
+
+
+def test_risk_stage_escalates_suspiciously_cheap_ad(db, monkeypatch):
+    conn = db.get_connection()
+    conn.execute("INSERT INTO users (user_id, chat_id) VALUES (1, 1)")
+    conn.execute("INSERT INTO urls (user_id, url) VALUES (1, 'https://kufar.by/l/phones')")
+    conn.commit()
+    url_id = conn.execute("SELECT id FROM urls").fetchone()[0]
+    conn.close()
+    monkeypatch.setattr(db, 'get_search_price_stats', lambda url_id: {'median': 1000, 'ads': 50})
+
+    db.append_events([
+        ('new', url_id, main.Listing('1', 'Дешевый телефон', 300), None),
+        ('new', url_id, main.Listing('2', 'Обычный телефон', 900), None),
+        ('price', url_id, main.Listing('3', 'Уцененный телефон', 200), 900),
+    ])
+    assert db.consume_feed('risk', db.risk_stage) == (3, 2)
+
+    conn = db.get_connection()
+    risks = dict(conn.execute("SELECT ad_id, risk_level FROM ad_risk").fetchall())
+    warnings = conn.execute("SELECT text FROM notifications").fetchall()
+    conn.close()
+    assert risks == {'1': 1, '3': 2}
+    assert len(warnings) == 2 and 'Риск объявления пересмотрен' in warnings[0][0]
+
+    # Повторное событие с тем же уровнем не дублирует предупреждение
+    db.append_events([('new', url_id, main.Listing('1', 'Дешевый телефон', 300), None)])
+    assert db.consume_feed('risk', db.risk_stage) == (1, 0)
+
+
+def test_failed_append_does_not_mark_ads_seen(db, monkeypatch):
+    items = [main.Listing('12', 'Диван', 300), main.Listing('11', 'Кресло', 150)]
+    monkeypatch.setattr(main, 'get_listings', lambda *args: items)
+    monkeypatch.setattr(main, 'seen_sets', {})
+    monkeypatch.setattr(main, 'url_fingerprints', {})
+    append_events = main.append_events
+
+    def locked(events):
+        raise main.sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(main, 'append_events', locked)
+    with pytest.raises(main.sqlite3.OperationalError):
+        main.check_url(1, 7, 'https://www.kufar.by/l/mebel', 0)
+    assert '12' not in main.get_seen_set(7)
+
+    # Повторная проверка находит те же объявления новыми
+    monkeypatch.setattr(main, 'append_events', append_events)
+    assert main.check_url(1, 7, 'https://www.kufar.by/l/mebel', 0) == 2
+    assert main.check_url(1, 7, 'https://www.kufar.by/l/mebel', 0) == 0
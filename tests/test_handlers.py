@@ -0,0 +1,41 @@
+"""Пулы обработчиков апдейтов"""
+import threading
+
+import main
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    callback_query = None
+
+    def __init__(self):
+        self.effective_message = FakeMessage()
+
+
+def test_quick_handlers_do_not_wait_behind_long_ones():
+    crawl_pool = main.HandlerPool(1, 1, 'test-crawl')
+    release = threading.Event()
+    quick_done = threading.Event()
+    long_handler = main.pooled('long', lambda update, context: release.wait(5), pool=crawl_pool)
+    quick_handler = main.pooled('quick', lambda update, context: quick_done.set())
+
+    long_handler(FakeUpdate(), None)
+    # Пул долгих задач занят: следующая долгая задача получает отказ, быстрая выполняется сразу
+    busy = FakeUpdate()
+    long_handler(busy, None)
+    quick_handler(FakeUpdate(), None)
+
+    try:
+        assert quick_done.wait(1)
+        assert busy.effective_message.replies == [main.BUSY_TEXT]
+        assert crawl_pool.stats() == {'pending': 1, 'limit': 1}
+    finally:
+        release.set()
+        crawl_pool.executor.shutdown(wait=True)
@@ -0,0 +1,76 @@
+"""Аренда ссылок воркерами"""
+import threading
+
+import main
+
+
+def add_urls(db, count, user_id=1):
+    conn = db.get_connection()
+    conn.execute("INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)", (user_id, user_id))
+    conn.executemany("INSERT INTO urls (user_id, url) VALUES (?, ?)",
+                     [(user_id, f'https://www.kufar.by/l/{user_id}/{i}') for i in range(count)])
+    conn.commit()
+    conn.close()
+
+
+def lease_of(db, url_id):
+    conn = db.get_connection()
+    try:
+        return conn.execute("SELECT lease_owner, due_at FROM urls WHERE id = ?", (url_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def test_workers_never_claim_the_same_rows(db):
+    add_urls(db, 30)
+    barrier = threading.Barrier(3)
+    claimed = {}
+
+    def work(worker_id):
+        barrier.wait()
+        claimed[worker_id] = [job[1] for job in db.claim_due_urls(worker_id, 10, 60)]
+
+    threads = [threading.Thread(target=work, args=(f'w{i}',)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    ids = [url_id for jobs in claimed.values() for url_id in jobs]
+    assert len(ids) == 30 and len(set(ids)) == 30
+    assert db.claim_due_urls('w3', 10, 60) == []
+
+
+def test_expired_lease_is_taken_over(db):
+    add_urls(db, 2)
+    # Воркер завис: срок его аренды уже истек
+    stale = [job[1] for job in db.claim_due_urls('stale', 10, -1)]
+
+    taken = [job[1] for job in db.claim_due_urls('fresh', 10, 60)]
+
+    assert sorted(taken) == sorted(stale)
+    assert lease_of(db, taken[0])[0] == 'fresh'
+
+
+def test_complete_does_not_clear_lease_of_new_owner(db):
+    add_urls(db, 1)
+    url_id = db.claim_due_urls('stale', 10, -1)[0][1]
+    db.claim_due_urls('fresh', 10, 60)
+
+    db.complete_url('stale', url_id)
+    assert lease_of(db, url_id) == ('fresh', 0)
+
+    db.complete_url('fresh', url_id)
+    owner, due_at = lease_of(db, url_id)
+    assert owner is None and due_at > main.time.time()
+    assert db.claim_due_urls('other', 10, 60) == []
+
+
+def test_released_leases_return_to_queue(db):
+    add_urls(db, 3)
+    db.claim_due_urls('stopped', 10, 60)
+    assert db.claim_due_urls('other', 10, 60) == []
+
+    db.release_leases('stopped')
+
+    assert len(db.claim_due_urls('other', 10, 60)) == 3
@@ -0,0 +1,76 @@
+"""Общий кэш результатов парсинга"""
+import threading
+import time
+
+import main
+
+
+def test_concurrent_requests_for_one_key_are_coalesced():
+    cache = main.ParseCache(ttl=60)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(previous):
+        calls.append(previous)
+        started.set()
+        release.wait(5)
+        return ['listing'], None
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch('k', fetch)))
+               for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [['listing']] * 5
+    assert cache.stats()['coalesced'] == 4
+
+
+def test_fresh_entry_is_served_without_fetch():
+    cache = main.ParseCache(ttl=60)
+    cache.put('k', ['cached'])
+
+    assert cache.get_or_fetch('k', lambda previous: (['fetched'], None)) == ['cached']
+    assert cache.stats()['hits'] == 1
+
+
+def test_stale_entry_passes_its_own_validators():
+    cache = main.ParseCache(ttl=0)
+    cache.put('a', ['a1'], ('"a"', None))
+    cache.put('b', ['b1'], ('"b"', None))
+    seen = {}
+
+    def fetch_for(key):
+        def fetch(previous):
+            seen[key] = previous
+            return previous
+        return fetch
+
+    time.sleep(0.01)
+    cache.get_or_fetch('a', fetch_for('a'))
+    cache.get_or_fetch('b', fetch_for('b'))
+
+    assert seen == {'a': (['a1'], ('"a"', None)), 'b': (['b1'], ('"b"', None))}
+
+
+def test_failed_fetch_does_not_poison_cache():
+    cache = main.ParseCache(ttl=60)
+
+    def broken(previous):
+        raise RuntimeError('blocked')
+
+    try:
+        cache.get_or_fetch('k', broken)
+    except RuntimeError:
+        pass
+
+    assert cache.peek('k') is None
+    assert cache.get_or_fetch('k', lambda previous: (['ok'], None)) == ['ok']
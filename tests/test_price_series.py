@@ -0,0 +1,35 @@
+"""Компактные ряды цен объявлений"""
+import main
+
+
+def test_varint_round_trip_including_negative_deltas():
+    points = [(1700000000, 1500), (1700003600, 1450), (1700090000, 1600), (1700090001, 0)]
+    blob = b''
+    ts = price = 0
+    for point_ts, point_price in points:
+        blob += main.encode_varint(point_ts - ts) + main.encode_varint(point_price - price)
+        ts, price = point_ts, point_price
+
+    assert main.decode_series(blob) == points
+
+
+def test_small_deltas_take_one_byte():
+    assert len(main.encode_varint(0)) == 1
+    assert len(main.encode_varint(-50)) == 1
+    assert len(main.encode_varint(63)) == 1
+    assert len(main.encode_varint(64)) == 2
+
+
+def test_daily_count_survives_restart_and_other_workers(db):
+    items = [main.Listing(1, 'Диван', 300), main.Listing(2, 'Кресло', 150)]
+    main.record_price_observations(5, items)
+    # Тот же набор после перезапуска или от другого воркера — уже учтен
+    main.record_price_observations(5, items)
+    main.record_price_observations(5, items + [main.Listing(3, 'Стол', 90)])
+
+    conn = main.get_connection()
+    try:
+        count, total = conn.execute("SELECT count, total FROM search_price_daily WHERE url_id = 5").fetchone()
+    finally:
+        conn.close()
+    assert (count, total) == (3, 540)
@@ -0,0 +1,41 @@
+"""Поиск повторно выложенных объявлений"""
+import main
+
+DESCRIPTION = (
+    "Продаю iPhone 13 128 ГБ, синий, батарея 89%, без сколов и царапин. "
+    "Полный комплект, коробка, чек. Встреча в центре Минска"
+)
+
+
+def test_same_description_is_flagged_as_repost(monkeypatch):
+    monkeypatch.setattr(main, 'LSH_INDEX', main.LSHIndex())
+
+    assert main.check_repost(1001, 'iPhone 13', DESCRIPTION, 1500) is None
+    assert main.check_repost(1002, 'iPhone 13', DESCRIPTION, 1450) == 1001
+
+
+def test_title_alone_is_never_flagged(monkeypatch):
+    monkeypatch.setattr(main, 'LSH_INDEX', main.LSHIndex())
+
+    assert main.check_repost(2001, 'iPhone 13', '', 1500) is None
+    assert main.check_repost(2002, 'iPhone 13', '', 1500) is None
+    assert main.check_repost(2003, 'iPhone 13', 'Торг', 1500) is None
+    assert main.check_repost(2004, 'iPhone 13', 'Торг', 1500) is None
+    assert not main.LSH_INDEX.ads
+
+
+def test_workers_pick_up_each_others_signatures(db, monkeypatch):
+    own = main.LSHIndex()
+    monkeypatch.setattr(main, 'LSH_INDEX', own)
+    main.load_lsh_index()
+
+    # Другой воркер увидел оригинал и записал подпись в БД
+    other = main.LSHIndex()
+    monkeypatch.setattr(main, 'LSH_INDEX', other)
+    main.check_repost(3001, 'iPhone 13', DESCRIPTION, 1500)
+    main.flush_signatures()
+
+    monkeypatch.setattr(main, 'LSH_INDEX', own)
+    main.load_lsh_index()
+    assert own.get(3001) is not None
+    assert main.check_repost(3002, 'iPhone 13', DESCRIPTION, 1500) == 3001
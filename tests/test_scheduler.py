@@ -0,0 +1,64 @@
+"""Справедливая очередь ссылок"""
+import pytest
+
+import main
+
+
+def job(user_id, url_id):
+    return (user_id, url_id, f'https://www.kufar.by/l/{url_id}', 0, None, None, None)
+
+
+def url_ids(jobs):
+    return [job[1] for job in jobs]
+
+
+@pytest.fixture(autouse=True)
+def polled(monkeypatch):
+    # Чем меньше ID, тем давнее проверялась ссылка
+    monkeypatch.setattr(main, 'url_last_polled', {url_id: url_id for url_id in range(100)})
+
+
+def test_users_are_served_round_robin():
+    jobs = [job(1, 11), job(1, 12), job(1, 13), job(2, 21), job(2, 22), job(3, 31)]
+
+    assert url_ids(main.FairScheduler(jobs)) == [11, 21, 31, 12, 22, 13]
+
+
+def test_url_budget_defers_the_rest_of_the_user():
+    scheduler = main.FairScheduler([job(1, 11), job(1, 12), job(1, 13), job(1, 14), job(2, 21)],
+                                   url_budget=2)
+
+    assert url_ids(scheduler) == [11, 21, 12]
+    assert url_ids(scheduler.pending()) == [13, 14]
+
+
+def test_request_budget_defers_the_rest_of_the_user():
+    scheduler = main.FairScheduler([job(1, 11), job(1, 12), job(2, 21), job(2, 22)], request_budget=5)
+
+    polled = []
+    for user_id, url_id, *_ in scheduler:
+        polled.append(url_id)
+        # Первая ссылка первого пользователя ушла на многостраничную выдачу
+        scheduler.charge(user_id, 5 if url_id == 11 else 1)
+
+    assert polled == [11, 21, 22]
+    assert url_ids(scheduler.pending()) == [12]
+
+
+def test_carried_urls_lead_the_next_cycle():
+    jobs = [job(1, 11), job(1, 12), job(1, 13), job(2, 21), job(2, 22)]
+    scheduler = main.FairScheduler(jobs)
+    # Дедлайн цикла: проверили только две ссылки
+    for count, _ in enumerate(scheduler, 1):
+        if count == 2:
+            break
+    carried = url_ids(scheduler.pending())
+    assert carried == [12, 13, 22]
+
+    assert url_ids(main.FairScheduler(jobs, carried=carried)) == [12, 22, 13, 21, 11]
+
+
+def test_most_lagging_user_goes_first():
+    jobs = [job(1, 11), job(2, 21), job(3, 31)]
+
+    assert url_ids(main.FairScheduler(jobs, lag={3: 120.0, 2: 30.0})) == [31, 21, 11]
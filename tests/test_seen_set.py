@@ -0,0 +1,49 @@
+"""Кольцо уже виденных объявлений ссылки"""
+import threading
+
+import main
+
+
+def test_add_reports_only_first_sighting():
+    seen = main.SeenSet()
+
+    assert seen.add(101)
+    assert not seen.add('101')
+    assert 101 in seen and '101' in seen
+    assert seen.dirty
+
+
+def test_oldest_ids_are_evicted_at_limit():
+    seen = main.SeenSet(limit=3)
+    for ad_id in (1, 2, 3, 4):
+        seen.add(ad_id)
+
+    assert 1 not in seen
+    assert [ad_id in seen for ad_id in (2, 3, 4)] == [True, True, True]
+    assert len(seen) == 3
+
+
+def test_blob_round_trip_keeps_order_and_non_numeric_ids():
+    seen = main.SeenSet()
+    for ad_id in (5, 'abc', 7):
+        seen.add(ad_id)
+
+    restored = main.SeenSet.from_blob(seen.to_blob())
+
+    assert list(restored.ring) == list(seen.ring)
+    assert 'abc' in restored
+    assert not restored.dirty
+
+
+def test_add_waits_for_flush_lock():
+    seen = main.SeenSet()
+    done = threading.Event()
+    worker = threading.Thread(target=lambda: (seen.add(1), done.set()))
+
+    with main.seen_sets_lock:
+        worker.start()
+        assert not done.wait(0.2)
+        assert not seen.dirty
+    worker.join(1)
+
+    assert done.is_set() and seen.dirty
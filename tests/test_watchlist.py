@@ -0,0 +1,112 @@
+"""Закладки на отдельные объявления"""
+import pytest
+import requests
+
+import main
+
+
+@pytest.fixture
+def prices(db, monkeypatch):
+    """Цены, которые «показывает» страница объявления; None — объявление снято (410)"""
+    current = {}
+    real_fetch_ad = main.fetch_ad
+
+    def removed_page(url, validators=None):
+        response = requests.Response()
+        response.status_code = 410
+        raise requests.HTTPError(response=response)
+
+    def fetch_ad(ad_id, previous=None):
+        if current.get(ad_id) is None:
+            # Снятое объявление проходит настоящий разбор ответа 410
+            return real_fetch_ad(ad_id, previous)
+        return [main.Listing(ad_id, f'Объявление {ad_id}', current[ad_id])], None
+
+    monkeypatch.setattr(main, 'PARSE_CACHE', main.ParseCache(ttl=0))
+    monkeypatch.setattr(main, 'fetch_page', removed_page)
+    monkeypatch.setattr(main, 'fetch_ad', fetch_ad)
+    conn = db.get_connection()
+    conn.executemany("INSERT INTO users (user_id, chat_id) VALUES (?, ?)", [(1, 1), (2, 2)])
+    conn.commit()
+    conn.close()
+    return current
+
+
+def query(db, sql, *args):
+    conn = db.get_connection()
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+
+def refresh_due(db):
+    """Следующее обновление, не дожидаясь WATCH_INTERVAL"""
+    conn = db.get_connection()
+    conn.execute("UPDATE watched_ads SET due_at = 0")
+    conn.commit()
+    conn.close()
+    return db.refresh_watched_ads('test')
+
+
+def test_first_refresh_only_stores_price(db, prices):
+    prices['501'] = 500
+    assert db.watch_ad(1, '501') == 'added'
+
+    assert db.refresh_watched_ads('test') == 0
+    assert query(db, "SELECT title, price, active FROM watched_ads") == [('Объявление 501', 500, 1)]
+    assert query(db, "SELECT COUNT(*) FROM ad_events") == [(0,)]
+
+
+def test_price_drop_notifies_every_watcher(db, prices):
+    prices['501'] = 500
+    db.watch_ad(1, '501')
+    db.watch_ad(2, '501')
+    db.refresh_watched_ads('test')
+
+    prices['501'] = 400
+    assert refresh_due(db) == 1
+    db.consume_feed('notify', db.notify_stage)
+
+    notifications = query(db, "SELECT user_id, text FROM notifications ORDER BY user_id")
+    assert [user_id for user_id, _ in notifications] == [1, 2]
+    assert '20.0%' in notifications[0][1] and '500 BYN' in notifications[0][1]
+
+
+def test_removed_ad_becomes_inactive_with_gone_event(db, prices):
+    prices['501'] = 500
+    db.watch_ad(1, '501')
+    db.refresh_watched_ads('test')
+
+    prices['501'] = None
+    assert refresh_due(db) == 1
+
+    assert query(db, "SELECT active FROM watched_ads") == [(0,)]
+    assert query(db, "SELECT kind, url_id, ad_id FROM ad_events") == [('gone', None, '501')]
+    db.consume_feed('notify', db.notify_stage)
+    assert 'снято с продажи' in query(db, "SELECT text FROM notifications")[0][0]
+    # Неактивное объявление больше не запрашивается
+    assert refresh_due(db) == 0
+
+
+def test_watch_limit_and_unwatch(db, prices, monkeypatch):
+    monkeypatch.setattr(main, 'WATCH_LIMIT', 2)
+
+    assert [db.watch_ad(1, ad_id) for ad_id in ('1', '2', '3')] == ['added', 'added', 'limit']
+    assert db.watch_ad(1, '1') == 'exists'
+    assert db.watch_ad(2, '1') == 'added'
+
+    assert db.unwatch_ad(1, '1')
+    assert not db.unwatch_ad(1, '1')
+    # Объявление 1 еще в закладках пользователя 2, объявление 2 — больше ни у кого
+    db.unwatch_ad(1, '2')
+    assert [ad_id for ad_id, in query(db, "SELECT ad_id FROM watched_ads")] == ['1']
+    assert db.watch_ad(1, '3') == 'added'
+
+
+def test_only_price_drops_are_reported():
+    item = main.Listing('501', 'Диван', 450)
+
+    assert main.format_watch_event('price', item, 500).startswith(main.WATCH_TEXT)
+    assert main.format_watch_event('price', item, 400) is None
+    assert main.format_watch_event('price', main.Listing('501', 'Диван', 0), 500) is None